@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Micro-benchmark do custo por mensagem de montar e serializar o payload
+
+Compara o caminho antigo (campos do remetente/chat montados a cada mensagem e o
+payload serializado separadamente para o outbox, o tamanho do lote e o corpo HTTP)
+com o atual (campos em cache e uma única serialização reaproveitada).
+
+Uso (no mesmo ambiente do serviço, ex.: dentro do container):
+    python benchmarks/bench_encode.py [--iterations 20000] [--stdlib-json]
+
+Nenhuma conexão é feita: o download de mídia é substituído por um resultado fixo.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+
+# Configuração mínima para importar o serviço sem credenciais reais (sempre imposta,
+# para não tocar nos arquivos de um .env carregado)
+_tmp = tempfile.mkdtemp(prefix='bench_encode_')
+os.environ.update({
+    'API_ID': '1',
+    'API_HASH': 'bench',
+    'GROUP_ID': '-1001234567890',
+    'WEBHOOK_URL': 'http://localhost/webhook',
+    'SESSION_PATH': os.path.join(_tmp, 'session'),
+    'STATE_PATH': os.path.join(_tmp, 'state.db'),
+    'OUTBOX_PATH': os.path.join(_tmp, 'outbox.db'),
+    'MEDIA_SPOOL_DIR': os.path.join(_tmp, 'media'),
+    'DEDUP_PATH': '',
+    'LOG_FILE': '',
+    'LOG_LEVEL': 'WARNING',
+    'ROUTES_FILE': '',
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_forwarder as tf  # noqa: E402
+
+tf.init_components()
+
+CHAT_KEY = 1234567890
+GROUP_ID = -1001234567890
+
+SENDER = tf.CachedEntity(types.SimpleNamespace(
+    id=67890, first_name='Maria', last_name='Silva', username='maria', bot=False),
+    expires_at=float('inf'))
+CHAT = tf.CachedEntity(types.SimpleNamespace(id=CHAT_KEY, title='Grupo de Pedidos'),
+                       expires_at=float('inf'))
+
+TEXT = 'Novo pedido recebido: 2x pizza grande, 1x refrigerante. Entregar até as 20h. ' * 3
+
+MEDIA_RESULTS = {
+    'url': {
+        'media_delivery': 'url',
+        'media_url': 'http://forwarder:8080/media/3f2a9c.jpg',
+        'media_sha256': '3f2a9c' * 10,
+        'media_size': 2 * 1024 * 1024,
+    },
+    'inline': {
+        'media_delivery': 'base64',
+        'media_base64': base64.b64encode(os.urandom(64 * 1024)).decode('ascii'),
+        'media_size': 64 * 1024,
+    },
+}
+
+
+def make_message(message_id, media=None):
+    return types.SimpleNamespace(
+        id=message_id,
+        text='' if media else TEXT,
+        media=media,
+        buttons=None,
+        date=datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc),
+        edit_date=None,
+    )
+
+
+def legacy_payload(message, sender, chat, media_fields):
+    """Montagem anterior: campos do remetente e do chat refeitos a cada mensagem"""
+    captured_at = datetime.now().isoformat()
+    data = {
+        'event': 'group_message',
+        'timestamp': captured_at,
+        'captured_at': captured_at,
+        'group_id': GROUP_ID,
+        'chat_id': CHAT_KEY,
+        'chat_id_abs': CHAT_KEY,
+        'chat_title': getattr(chat, 'title', None),
+        'chat_type': getattr(chat, 'entity_type', None),
+        'message_id': message.id,
+        'date': message.date.isoformat(),
+        'text': message.text or '',
+        'message_info': message.text[:200] if message.text else '[Mensagem com mídia]',
+        'has_buttons': False,
+        'buttons_info': '',
+        'sender_id': sender.id if sender else None,
+        'sender_name': f"{getattr(sender, 'first_name', '') or ''} {getattr(sender, 'last_name', '') or ''}",
+        'sender_username': getattr(sender, 'username', ''),
+        'is_bot': getattr(sender, 'bot', False),
+        'has_media': bool(message.media),
+        'media_type': 'photo' if message.media else 'none',
+        'media_details': {},
+    }
+    if media_fields:
+        data.update(media_fields)
+    return data
+
+
+def legacy_encode(data):
+    """Serializações anteriores: outbox, tamanho do lote e corpo HTTP"""
+    json.dumps(data, default=str)
+    len(json.dumps(data, default=str).encode('utf-8'))
+    return json.dumps(data, default=str).encode('utf-8')
+
+
+async def bench_case(media_kind, iterations):
+    media = types.SimpleNamespace(photo=object()) if media_kind else None
+    media_fields = dict(MEDIA_RESULTS[media_kind]) if media_kind else None
+
+    async def fetch(message, file_ext):
+        return media_fields
+
+    tf.media_spool.fetch = fetch
+    messages = [make_message(i, media) for i in range(iterations)]
+
+    started = time.perf_counter()
+    for message in messages:
+        legacy_encode(legacy_payload(message, SENDER, CHAT, media_fields))
+    legacy = (time.perf_counter() - started) / iterations
+
+    started = time.perf_counter()
+    for message in messages:
+        data = await tf.build_message_payload(message, CHAT_KEY, GROUP_ID, SENDER, CHAT)
+        body = tf.encode_json(data)
+    current = (time.perf_counter() - started) / iterations
+    return legacy, current, len(body)
+
+
+async def run(iterations):
+    encoder = 'orjson' if tf.orjson is not None else 'json'
+    print(f"Serializador: {encoder} | {iterations} mensagens por caso")
+    print(f"{'caso':<18}{'anterior (µs)':>15}{'atual (µs)':>13}{'ganho':>8}{'bytes':>9}")
+    for label, media_kind in (('texto', None), ('mídia (url)', 'url'),
+                              ('mídia (base64)', 'inline')):
+        legacy, current, size = await bench_case(media_kind, iterations)
+        print(f"{label:<18}{legacy * 1e6:>15.1f}{current * 1e6:>13.1f}"
+              f"{legacy / current:>7.1f}x{size:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20000,
+                        help="mensagens por caso (padrão: 20000)")
+    parser.add_argument('--stdlib-json', action='store_true',
+                        help="usa o json da biblioteca padrão mesmo com orjson instalado")
+    args = parser.parse_args()
+    if args.stdlib_json:
+        tf.orjson = None
+    asyncio.run(run(args.iterations))
+
+
+if __name__ == '__main__':
+    main()
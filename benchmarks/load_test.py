@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""Teste de carga offline do pipeline de encaminhamento
+
+Gera eventos NewMessage sintéticos (texto, fotos, documentos e álbuns, em rajadas
+opcionais), entrega-os ao handler do serviço e recebe os payloads em um webhook
+local com latência e erros configuráveis. Nenhuma conexão com o Telegram é feita:
+remetentes, chats e downloads de mídia são simulados.
+
+Ao final informa vazão, latência ponta a ponta (evento recebido -> payload no
+webhook) p50/p99 e o pico de memória (RSS) do processo.
+
+Uso (no mesmo ambiente do serviço, ex.: dentro do container):
+    python benchmarks/load_test.py --messages 5000 --rate 500
+    python benchmarks/load_test.py --mix text=1 --sink-latency-ms 200 --sink-error-rate 0.05
+
+As configurações do serviço (DELIVERY_WORKERS, WEBHOOK_BATCH_SIZE etc.) são lidas
+do ambiente, como em produção.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+CHAT_ID = -1001234567890
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+SINK_PORT = free_port()
+
+# Ambiente isolado: arquivos temporários e o webhook apontando para o receptor local.
+# Estes valores são sempre impostos (um .env carregado pelo docker compose não deve
+# levar o teste a usar o banco ou o webhook reais); do ambiente só vêm os ajustes
+# de entrega (DELIVERY_*, WEBHOOK_BATCH_* etc.)
+_tmp = tempfile.mkdtemp(prefix='load_test_')
+os.environ.update({
+    'API_ID': '1',
+    'API_HASH': 'load-test',
+    'GROUP_ID': str(CHAT_ID),
+    'WEBHOOK_URL': f'http://127.0.0.1:{SINK_PORT}/webhook',
+    'SESSION_PATH': os.path.join(_tmp, 'session'),
+    'STATE_PATH': os.path.join(_tmp, 'state.db'),
+    'OUTBOX_PATH': os.path.join(_tmp, 'outbox.db'),
+    'MEDIA_SPOOL_DIR': os.path.join(_tmp, 'media'),
+    'DEDUP_PATH': '',
+    'LOG_FILE': '',
+    'LOG_LEVEL': 'WARNING',
+    # Os downloads são locais: o limitador do Telegram não deve ser o gargalo
+    'TELEGRAM_RATE_LIMIT': '100000',
+    'TELEGRAM_BURST': '100000',
+    # Valores vazios/desativados em vez de remover: o load_dotenv do serviço não
+    # sobrescreve variáveis definidas, mas recolocaria as ausentes a partir do .env
+    'ROUTES_FILE': '',
+    'SHARDING_ENABLED': 'false',
+    'CATCHUP_ON_START': 'false',
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_forwarder as tf  # noqa: E402
+
+tf.init_components()
+
+CHAT = types.SimpleNamespace(id=tf.normalize_chat_id(CHAT_ID), title='Grupo de Carga')
+TEXTS = [
+    'Novo pedido recebido: 2x pizza grande, 1x refrigerante.',
+    'Status do servidor: todos os serviços operacionais.',
+    'Lembrete: reunião às 15h na sala 3. ' * 4,
+]
+
+
+class FakeMessage:
+    """Mensagem com a interface usada pelo serviço (atributos e corrotinas do Telethon)"""
+
+    def __init__(self, message_id, sender, kind, media_bytes, download_latency,
+                 grouped_id=None):
+        self.id = message_id
+        self.sender_id = sender.id
+        self._sender = sender
+        self.text = random.choice(TEXTS) if kind == 'text' or not grouped_id else ''
+        self.date = datetime.now(timezone.utc)
+        self.edit_date = None
+        self.grouped_id = grouped_id
+        self.buttons = None
+        self.action = None
+        self.photo = None
+        self.document = None
+        self.media = None
+        if kind in ('photo', 'album'):
+            self.photo = types.SimpleNamespace(id=message_id)
+            self.media = types.SimpleNamespace(photo=self.photo)
+        elif kind == 'document':
+            self.document = types.SimpleNamespace(
+                id=message_id, mime_type='application/pdf', filename=f'relatorio_{message_id}.pdf')
+            self.media = types.SimpleNamespace(document=self.document)
+        self._media_bytes = media_bytes
+        self._download_latency = download_latency
+
+    async def get_sender(self):
+        return self._sender
+
+    async def get_chat(self):
+        return CHAT
+
+    async def download_media(self, file):
+        await asyncio.sleep(self._download_latency)
+        with open(file, 'wb') as f:
+            f.write(os.urandom(self._media_bytes))
+        return file
+
+
+class Sink:
+    """Webhook local que registra a chegada de cada mensagem, com latência e erros simulados"""
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.received = {}
+        self.requests = 0
+        self.errors = 0
+        self.duplicates = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        body = await request.read()
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text='erro simulado')
+        now = time.monotonic()
+        payload = json.loads(body)
+        for item in payload if isinstance(payload, list) else [payload]:
+            for message_id in item.get('message_ids') or [item.get('message_id')]:
+                if message_id is None:
+                    continue
+                if message_id in self.received:
+                    self.duplicates += 1
+                else:
+                    self.received[message_id] = now
+        return web.Response(text='ok')
+
+    async def start(self, port):
+        app = web.Application(client_max_size=256 * 1024 ** 2)
+        app.router.add_post('/webhook', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('text', 'photo', 'document', 'album'):
+            raise argparse.ArgumentTypeError(f"tipo de mensagem desconhecido: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def generate(args):
+    """Sequência de rajadas de mensagens sintéticas (álbuns ocupam várias mensagens)"""
+    ids = itertools.count(1)
+    grouped_ids = itertools.count(1)
+    senders = [types.SimpleNamespace(id=1000 + i, first_name=f'Usuário {i}', last_name=None,
+                                     username=f'usuario{i}', bot=i % 10 == 0)
+               for i in range(args.senders)]
+    kinds, weights = zip(*args.mix.items())
+    burst = []
+    total = 0
+    while total < args.messages:
+        kind = random.choices(kinds, weights)[0]
+        sender = random.choice(senders)
+        media_bytes = args.media_bytes
+        latency = args.download_latency_ms / 1000
+        if kind == 'album':
+            grouped_id = next(grouped_ids)
+            parts = min(args.album_size, args.messages - total)
+            burst.extend(FakeMessage(next(ids), sender, kind, media_bytes, latency, grouped_id)
+                         for _ in range(parts))
+            total += parts
+        else:
+            burst.append(FakeMessage(next(ids), sender, kind, media_bytes, latency))
+            total += 1
+        if len(burst) >= args.burst:
+            yield burst
+            burst = []
+    if burst:
+        yield burst
+
+
+async def run(args):
+    sink = Sink(args.sink_latency_ms / 1000, args.sink_jitter_ms / 1000, args.sink_error_rate)
+    await sink.start(SINK_PORT)
+
+    # Mesma inicialização de main(), sem conectar ao Telegram
+    if tf.outbox is not None:
+        tf.outbox.open()
+        tf.outbox.start()
+    tf.chat_state.open()
+    tf.chat_state.start()
+    tf.dedup_index.open()
+    tf.delivery_queue.start()
+    tf.media_spool.open()
+    redrive = None
+    if tf.outbox is not None:
+        redrive = asyncio.create_task(tf.delivery_queue.redrive_loop(
+            tf.OUTBOX_REDRIVE_INTERVAL, tf.OUTBOX_COMPACT_INTERVAL))
+
+    injected = {}
+    handlers = set()
+    interval = args.burst / args.rate if args.rate else 0
+    started = time.monotonic()
+    print(f"Enviando {args.messages} mensagens (rajadas de {args.burst}, "
+          f"{'sem limite de taxa' if not args.rate else f'{args.rate:g} msg/s'})...")
+    for i, burst in enumerate(generate(args)):
+        if interval:
+            # Mantém a taxa média mesmo que o handler atrase a geração
+            delay = started + i * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        for message in burst:
+            injected[message.id] = time.monotonic()
+            event = types.SimpleNamespace(chat_id=CHAT_ID, message=message,
+                                          sender_id=message.sender_id)
+            # Como o Telethon, cada atualização é tratada em uma tarefa própria
+            task = asyncio.create_task(tf.dispatcher(event))
+            handlers.add(task)
+            task.add_done_callback(handlers.discard)
+    injection_time = time.monotonic() - started
+
+    deadline = time.monotonic() + args.timeout
+    while len(sink.received) < len(injected) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    finished = max(sink.received.values(), default=time.monotonic())
+
+    latencies = [sink.received[message_id] - injected[message_id]
+                 for message_id in sink.received if message_id in injected]
+    delivered = len(latencies)
+    elapsed = finished - started
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    stats = tf.delivery_queue.stats()
+
+    print()
+    print(f"Mensagens entregues:       {delivered}/{len(injected)}"
+          f"{' (tempo esgotado)' if delivered < len(injected) else ''}")
+    print(f"Tempo de injeção:          {injection_time:.2f} s")
+    print(f"Tempo total:               {elapsed:.2f} s")
+    print(f"Vazão:                     {delivered / elapsed if elapsed else 0:.1f} msg/s")
+    print(f"Latência p50:              {percentile(latencies, 0.50) * 1000:.1f} ms")
+    print(f"Latência p99:              {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"Latência máxima:           {max(latencies, default=float('nan')) * 1000:.1f} ms")
+    print(f"Requisições ao webhook:    {sink.requests} ({sink.errors} erros simulados, "
+          f"{sink.duplicates} duplicados)")
+    print(f"Lotes / reenvios:          {stats['batches']} / {stats['replayed']}")
+    print(f"Pico de memória (RSS):     {peak_rss_mb:.1f} MB")
+
+    if redrive is not None:
+        redrive.cancel()
+        await asyncio.gather(redrive, return_exceptions=True)
+    await asyncio.gather(*handlers, return_exceptions=True)
+    await tf.album_aggregator.flush()
+    await tf.delivery_queue.stop()
+    if tf.outbox is not None:
+        await tf.outbox.close()
+    await tf.chat_state.close()
+    await tf.dedup_index.close()
+    await tf.webhook_client.close()
+    tf.media_spool.close()
+    await sink.runner.cleanup()
+    return delivered == len(injected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000,
+                        help="total de mensagens geradas (padrão: 2000)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="mensagens por segundo (padrão: 0 = o mais rápido possível)")
+    parser.add_argument('--burst', type=int, default=1,
+                        help="mensagens injetadas de uma vez em cada rajada (padrão: 1)")
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('text=0.7,photo=0.15,document=0.1,album=0.05'),
+                        help="proporção dos tipos, ex.: text=0.7,photo=0.15,document=0.1,album=0.05")
+    parser.add_argument('--album-size', type=int, default=4, help="itens por álbum (padrão: 4)")
+    parser.add_argument('--senders', type=int, default=50, help="remetentes distintos (padrão: 50)")
+    parser.add_argument('--media-bytes', type=int, default=200 * 1024,
+                        help="tamanho de cada mídia (padrão: 204800)")
+    parser.add_argument('--download-latency-ms', type=float, default=50,
+                        help="tempo simulado de download de cada mídia (padrão: 50)")
+    parser.add_argument('--sink-latency-ms', type=float, default=20,
+                        help="latência do webhook local (padrão: 20)")
+    parser.add_argument('--sink-jitter-ms', type=float, default=10,
+                        help="variação aleatória somada à latência (padrão: 10)")
+    parser.add_argument('--sink-error-rate', type=float, default=0,
+                        help="fração de requisições respondidas com 503 (padrão: 0)")
+    parser.add_argument('--timeout', type=float, default=300,
+                        help="espera máxima pelas entregas, em segundos (padrão: 300)")
+    parser.add_argument('--seed', type=int, default=None, help="semente aleatória")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == '__main__':
+    main()
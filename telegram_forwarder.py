@@ -1,11 +1,43 @@
 from telethon import TelegramClient, events
-import requests
+from telethon.errors import FloodWaitError
+import aiohttp
+from aiohttp import web
+import base64
+import copy
+import email.utils
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
 import json
+import argparse
 import asyncio
+import atexit
+import contextlib
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import signal
+import socket
+import sqlite3
 import dotenv
-from datetime import datetime
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+try:
+    import yaml
+except ImportError:  # YAML é opcional: arquivos de rotas JSON funcionam sem ele
+    yaml = None
+
+try:
+    import orjson
+except ImportError:  # orjson é opcional: sem ele os payloads usam o json da biblioteca padrão
+    orjson = None
 
 # Carregar variáveis do arquivo .env
 dotenv.load_dotenv()
@@ -14,406 +46,3365 @@ dotenv.load_dotenv()
 API_ID = int(os.environ.get('API_ID'))
 API_HASH = os.environ.get('API_HASH')
 PHONE_NUMBER = os.environ.get('PHONE_NUMBER')
-GROUP_ID = int(os.environ.get('GROUP_ID'))
+# GROUP_ID/WEBHOOK_URL definem a rota padrão; para vários grupos/webhooks use ROUTES_FILE
+GROUP_ID = int(os.environ['GROUP_ID']) if os.environ.get('GROUP_ID') else None
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+ROUTES_FILE = os.environ.get('ROUTES_FILE')
+
+# Sharding: várias instâncias, cada uma com sua sessão, dividem os chats monitorados
+# por meio de leases em um banco compartilhado
+SHARDING_ENABLED = os.environ.get('SHARDING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+SHARD_INSTANCE_ID = os.environ.get('SHARD_INSTANCE_ID') or socket.gethostname()
+SHARD_LEASE_PATH = os.environ.get('SHARD_LEASE_PATH', '/app/shared/leases.db')
+SHARD_LEASE_TTL = float(os.environ.get('SHARD_LEASE_TTL', '30'))
+SHARD_RENEW_INTERVAL = float(os.environ.get('SHARD_RENEW_INTERVAL', '10'))
+
+
+def instance_path(path):
+    """Substitui {instance} pelo ID da instância (arquivos locais de cada réplica)"""
+    return path.replace('{instance}', SHARD_INSTANCE_ID) if path else path
+
+
+# Configurações do cliente HTTP do webhook (pool de conexões e timeouts)
+WEBHOOK_POOL_SIZE = int(os.environ.get('WEBHOOK_POOL_SIZE', '10'))
+WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', '10'))
+WEBHOOK_CONNECT_TIMEOUT = float(os.environ.get('WEBHOOK_CONNECT_TIMEOUT', '5'))
+WEBHOOK_KEEPALIVE = float(os.environ.get('WEBHOOK_KEEPALIVE', '30'))
+
+# Concorrência adaptativa (AIMD) e circuit breaker por webhook
+WEBHOOK_MIN_CONCURRENCY = int(os.environ.get('WEBHOOK_MIN_CONCURRENCY', '1'))
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get('WEBHOOK_MAX_CONCURRENCY', '8'))
+# Latência (segundos) acima da qual o webhook é considerado lento
+WEBHOOK_LATENCY_TARGET = float(os.environ.get('WEBHOOK_LATENCY_TARGET', '2'))
+# Falhas consecutivas (timeout, 5xx, 429) que abrem o circuito
+WEBHOOK_BREAKER_THRESHOLD = int(os.environ.get('WEBHOOK_BREAKER_THRESHOLD', '5'))
+# Tempo (segundos) com o circuito aberto antes da requisição de teste
+WEBHOOK_BREAKER_COOLDOWN = float(os.environ.get('WEBHOOK_BREAKER_COOLDOWN', '30'))
+
+# Configurações da fila de entrega (desacopla a captura do envio ao webhook)
+DELIVERY_QUEUE_SIZE = int(os.environ.get('DELIVERY_QUEUE_SIZE', '1000'))
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', '4'))
+DELIVERY_MAX_RETRIES = int(os.environ.get('DELIVERY_MAX_RETRIES', '3'))
+# Política quando a fila está cheia: block, drop_oldest ou spill
+DELIVERY_BACKPRESSURE = os.environ.get('DELIVERY_BACKPRESSURE', 'block').lower()
+DELIVERY_SPILL_PATH = instance_path(os.environ.get(
+    'DELIVERY_SPILL_PATH', '/app/telegram_session/delivery_spill.jsonl'))
+
+# Outbox persistente: payloads sobrevivem a quedas do n8n e reinícios do processo
+OUTBOX_ENABLED = os.environ.get('OUTBOX_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+OUTBOX_PATH = instance_path(os.environ.get('OUTBOX_PATH', '/app/telegram_session/outbox.db'))
+OUTBOX_COMMIT_INTERVAL = float(os.environ.get('OUTBOX_COMMIT_INTERVAL', '0.05'))
+OUTBOX_COMMIT_BATCH = int(os.environ.get('OUTBOX_COMMIT_BATCH', '200'))
+OUTBOX_REDRIVE_INTERVAL = float(os.environ.get('OUTBOX_REDRIVE_INTERVAL', '30'))
+OUTBOX_COMPACT_INTERVAL = float(os.environ.get('OUTBOX_COMPACT_INTERVAL', '300'))
+
+# Modo de entrega em lote (opcional): várias mensagens em um único POST com array JSON
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '1'))
+WEBHOOK_BATCH_WINDOW_MS = float(os.environ.get('WEBHOOK_BATCH_WINDOW_MS', '500'))
+WEBHOOK_BATCH_MAX_BYTES = int(os.environ.get('WEBHOOK_BATCH_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# Mídias: até MEDIA_INLINE_MAX_BYTES vão em base64; acima disso, por URL do servidor local.
+# Os arquivos ficam em cache no disco (LRU limitado a MEDIA_CACHE_MAX_BYTES)
+MEDIA_INLINE_MAX_BYTES = int(os.environ.get('MEDIA_INLINE_MAX_BYTES', str(1024 * 1024)))
+MEDIA_SPOOL_DIR = instance_path(os.environ.get('MEDIA_SPOOL_DIR', '/app/temp/media'))
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+MEDIA_CHUNK_SIZE = 512 * 1024
+
+# Limitador de requisições ao Telegram (MTProto), adaptado automaticamente a FloodWait
+TELEGRAM_RATE_LIMIT = float(os.environ.get('TELEGRAM_RATE_LIMIT', '20'))
+TELEGRAM_MIN_RATE = float(os.environ.get('TELEGRAM_MIN_RATE', '1'))
+TELEGRAM_BURST = int(os.environ.get('TELEGRAM_BURST', '20'))
+MEDIA_MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MEDIA_MAX_CONCURRENT_DOWNLOADS', '3'))
+# FloodWait até este limite (segundos) é aguardado internamente pelo Telethon, o que
+# cobre também as chamadas fora do limitador (atualizações, get_me, iter_messages);
+# esperas maiores chegam ao limitador, que pausa e reduz a taxa
+TELEGRAM_FLOOD_SLEEP_THRESHOLD = int(os.environ.get('TELEGRAM_FLOOD_SLEEP_THRESHOLD', '60'))
+
+# Servidor HTTP local (mídias)
+HTTP_HOST = os.environ.get('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = int(os.environ.get('HTTP_PORT', '8080'))
+MEDIA_PUBLIC_URL = os.environ.get(
+    'MEDIA_PUBLIC_URL', f"http://{socket.gethostname()}:{HTTP_PORT}")
+# Token do endpoint administrativo (POST /admin/reload); vazio desativa o endpoint
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Cache de remetentes e chats (evita get_sender/get_chat no Telegram a cada mensagem)
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', '50000'))
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', '3600'))
+# Participantes pré-carregados por grupo monitorado na inicialização (0 desativa)
+ENTITY_PREFILL_LIMIT = int(os.environ.get('ENTITY_PREFILL_LIMIT', '10000'))
+
+# Catch-up: ao iniciar, recupera as mensagens enviadas enquanto o serviço esteve parado
+STATE_PATH = instance_path(os.environ.get('STATE_PATH', '/app/telegram_session/state.db'))
+CATCHUP_ON_START = os.environ.get('CATCHUP_ON_START', 'true').lower() in ('1', 'true', 'yes')
+CATCHUP_MAX_MESSAGES = int(os.environ.get('CATCHUP_MAX_MESSAGES', '5000'))
+# Pausa (segundos) entre páginas de 100 mensagens ao ler o histórico
+CATCHUP_WAIT_TIME = float(os.environ.get('CATCHUP_WAIT_TIME', '1'))
+
+# Índice de duplicados: mensagens repetidas dentro da janela (segundos) não são reenviadas
+DEDUP_WINDOW = float(os.environ.get('DEDUP_WINDOW', '86400'))
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', '200000'))
+# Banco onde o índice é persistido entre reinícios (vazio mantém apenas em memória)
+DEDUP_PATH = instance_path(os.environ.get('DEDUP_PATH', STATE_PATH))
+
+# Encaminhar também mensagens de outros chats como evento de teste (diagnóstico)
+FORWARD_OTHER_CHATS = os.environ.get('FORWARD_OTHER_CHATS', 'false').lower() in ('1', 'true', 'yes')
+
+# Eventos além das mensagens novas: edições, exclusões e ações de membros/chat
+FORWARD_EDITS = os.environ.get('FORWARD_EDITS', 'true').lower() in ('1', 'true', 'yes')
+FORWARD_DELETES = os.environ.get('FORWARD_DELETES', 'true').lower() in ('1', 'true', 'yes')
+FORWARD_CHAT_ACTIONS = os.environ.get('FORWARD_CHAT_ACTIONS', 'true').lower() in ('1', 'true', 'yes')
+# Janela (segundos) em que edições sucessivas da mesma mensagem viram uma só entrega (0 desativa)
+EDIT_COALESCE_WINDOW = float(os.environ.get('EDIT_COALESCE_WINDOW', '3'))
+# Janela (segundos) para reunir as partes de um álbum em um único evento (0 envia cada parte)
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', '1'))
+
+STATS_LOG_INTERVAL = float(os.environ.get('STATS_LOG_INTERVAL', '60'))
+
+# Tempo máximo (segundos) para esvaziar a fila de entrega ao encerrar; o que sobrar
+# continua no outbox e é reenviado na próxima execução
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', '8'))
+
+# Configurar logging
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Níveis por componente, ex.: "delivery=DEBUG,media=INFO,telethon=WARNING"
+LOG_LEVELS = os.environ.get('LOG_LEVELS', 'telethon=WARNING')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+LOG_FILE = os.environ.get('LOG_FILE', '/app/logs/telegram_forwarder.log')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+# Tamanho máximo (caracteres) de payloads incluídos nos logs
+LOG_PAYLOAD_MAX = int(os.environ.get('LOG_PAYLOAD_MAX', '500'))
+
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por registro de log"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Enfileira o registro só com a mensagem interpolada
+
+    O QueueHandler padrão formata o registro (inclusive o traceback) no loop e descarta
+    exc_info; aqui a formatação fica toda para a thread de gravação.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        # Interpola agora: os argumentos podem mudar antes de a thread formatar
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging():
+    """Logging não bloqueante: o loop só interpola a mensagem e enfileira; uma thread
+    formata (inclusive tracebacks) e grava"""
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    output_handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        output_handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8'))
+    for output_handler in output_handlers:
+        output_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [LogQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(','))):
+        name, _, level = item.partition('=')
+        name = name.strip()
+        if not name.startswith('telethon') and not name.startswith('telegram_forwarder'):
+            name = f"telegram_forwarder.{name}"
+        logging.getLogger(name).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(
+        log_queue, *output_handlers, respect_handler_level=True)
+    listener.start()
+    # Garante que os registros pendentes sejam gravados ao encerrar
+    atexit.register(listener.stop)
+    return listener
+
+
+def encode_json(data):
+    """Serializa o payload uma única vez em bytes (UTF-8, compacto)
+
+    Os bytes são reutilizados no outbox, no cálculo do tamanho dos lotes e no corpo
+    da requisição HTTP. Usa orjson quando instalado.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=str, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def summarize_payload(data, body=None):
+    """Versão do payload para log: sem base64 e truncada em LOG_PAYLOAD_MAX caracteres
+
+    Sem mídia inline, os bytes já serializados (body) são reaproveitados; com data
+    None, o payload é decodificado do body apenas se houver base64 a remover.
+    """
+    if body is not None and b'"media_base64"' not in body:
+        text = body[:LOG_PAYLOAD_MAX + 1].decode('utf-8', errors='replace')
+        if len(body) > LOG_PAYLOAD_MAX:
+            text = f"{text[:LOG_PAYLOAD_MAX]}... ({len(body)} bytes)"
+        return text
+    if data is None:
+        data = json.loads(body)
+
+    def strip_media(item):
+        if isinstance(item, dict) and 'media_base64' in item:
+            item = dict(item, media_base64=f"<{len(item['media_base64'])} caracteres>")
+        return item
+
+    if isinstance(data, list):
+        data = [strip_media(item) for item in data]
+    else:
+        data = strip_media(data)
+    text = json.dumps(data, default=str, ensure_ascii=False)
+    if len(text) > LOG_PAYLOAD_MAX:
+        text = f"{text[:LOG_PAYLOAD_MAX]}... ({len(text)} caracteres)"
+    return text
+
+
+logger = logging.getLogger('telegram_forwarder')
+# Loggers por componente (níveis ajustáveis em LOG_LEVELS)
+delivery_logger = logger.getChild('delivery')
+media_logger = logger.getChild('media')
+
+# Definir caminho absoluto para o arquivo de sessão
+SESSION_PATH = instance_path(
+    os.environ.get('SESSION_PATH', '/app/telegram_session/telegram_session'))
+
+
+class Metric:
+    """Métrica com rótulos no formato de exposição do Prometheus"""
+
+    def __init__(self, name, help_text, metric_type, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    @staticmethod
+    def _format_labels(names, values, extra=None):
+        pairs = list(zip(names, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"') for _, v in pairs)
+        return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, 'counter', labels)
+        if not self.labels:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class CallbackMetric(Metric):
+    """Métrica lida no momento da coleta a partir de uma função"""
+
+    def __init__(self, name, help_text, metric_type, callback):
+        super().__init__(name, help_text, metric_type)
+        self.callback = callback
+
+    def samples(self):
+        yield self.name, '', self.callback()
+
+
+class Histogram(Metric):
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, 'histogram', labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Contagens por bucket, soma e total
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = self._format_labels(self.labels, key, ('le', str(bound)))
+                yield f"{self.name}_bucket", labels, bucket_count
+            labels = self._format_labels(self.labels, key, ('le', '+Inf'))
+            yield f"{self.name}_bucket", labels, count
+            yield f"{self.name}_sum", self._format_labels(self.labels, key), total
+            yield f"{self.name}_count", self._format_labels(self.labels, key), count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+metrics = MetricsRegistry()
+MESSAGES_RECEIVED = metrics.register(Counter(
+    'telegram_forwarder_messages_received_total',
+    'Mensagens recebidas dos chats monitorados'))
+STAGE_SECONDS = metrics.register(Histogram(
+    'telegram_forwarder_stage_seconds',
+    'Latência por etapa: build (recebimento até payload montado), media_download, '
+    'queue_wait (espera na fila) e end_to_end (recebimento até confirmação do webhook)',
+    labels=('stage',)))
+WEBHOOK_REQUEST_SECONDS = metrics.register(Histogram(
+    'telegram_forwarder_webhook_request_seconds',
+    'Duração de cada requisição ao webhook'))
+WEBHOOK_RESPONSES = metrics.register(Counter(
+    'telegram_forwarder_webhook_responses_total',
+    'Respostas do webhook por status HTTP (error para falhas de conexão/timeout)',
+    labels=('status',)))
+WEBHOOK_RETRIES = metrics.register(Counter(
+    'telegram_forwarder_webhook_retries_total',
+    'Novas tentativas de envio ao webhook'))
+CONFIG_RELOADS = metrics.register(Counter(
+    'telegram_forwarder_config_reloads_total',
+    'Recargas do arquivo de rotas por resultado (ok ou error)',
+    labels=('result',)))
+EVENT_LOOP_LAG = metrics.register(Histogram(
+    'telegram_forwarder_event_loop_lag_seconds',
+    'Atraso do loop de eventos em relação ao agendado',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)))
+
+
+# Tarefas em segundo plano do modo contínuo (catch-up, redrive, heartbeats etc.),
+# canceladas no encerramento antes de esvaziar a fila de entrega
+background_tasks = set()
+shutting_down = False
+
+
+def spawn(coro):
+    """Cria uma tarefa em segundo plano registrada para o encerramento"""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def cancel_background_tasks():
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Execuções em andamento dos handlers do Telegram (o Telethon trata cada atualização
+# em uma tarefa própria); o encerramento as aguarda antes de fechar a fila e os bancos
+handler_tasks = set()
+
+
+def tracked_handler(callback):
+    """Registra cada execução do handler em handler_tasks"""
+    @functools.wraps(callback)
+    async def wrapper(event):
+        task = asyncio.current_task()
+        handler_tasks.add(task)
+        try:
+            return await callback(event)
+        finally:
+            handler_tasks.discard(task)
+    return wrapper
+
+
+async def wait_handler_tasks(timeout):
+    """Aguarda os handlers em andamento; os que excedem o prazo são cancelados"""
+    tasks = list(handler_tasks)
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=max(timeout, 0))
+    if pending:
+        logger.warning(
+            f"{len(pending)} atualizações ainda em processamento após {timeout:g}s; canceladas")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def monitor_event_loop_lag(interval=0.5):
+    """Mede o atraso do loop de eventos (indicador de código bloqueante)"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(time.monotonic() - started - interval, 0.0))
+
+
+class WebhookResponse:
+    """Resposta do webhook já lida (status e corpo)"""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class WebhookClient:
+    """Cliente HTTP assíncrono compartilhado, com pool de conexões keep-alive"""
+
+    def __init__(self, pool_size, timeout, connect_timeout, keepalive):
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.keepalive = keepalive
+        self._session = None
+
+    def _get_session(self):
+        # A sessão precisa ser criada dentro do loop em execução
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=self.keepalive)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                json_serialize=lambda obj: json.dumps(obj, default=str))
+        return self._session
+
+    async def post(self, url, data, timeout=None, raise_for_status=False, headers=None):
+        """Envia o payload para o webhook sem bloquear o loop de eventos"""
+        session = self._get_session()
+        if isinstance(data, (bytes, bytearray)):
+            # Payload já serializado por encode_json
+            kwargs = {'data': data,
+                      'headers': {'Content-Type': 'application/json', **(headers or {})}}
+        else:
+            kwargs = {'json': data}
+            if headers:
+                kwargs['headers'] = headers
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        async with session.post(url, **kwargs) as response:
+            text = await response.text()
+            if raise_for_status:
+                response.raise_for_status()
+            return WebhookResponse(response.status, text)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+def parse_retry_after(value):
+    """Segundos indicados no cabeçalho Retry-After (número ou data HTTP)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class WebhookTarget:
+    """Concorrência adaptativa (AIMD) e circuit breaker de um webhook
+
+    O limite de requisições simultâneas cresce aos poucos enquanto a latência está
+    abaixo do alvo e cai pela metade com lentidão, timeouts ou 5xx. Após falhas
+    consecutivas o circuito abre; passado o tempo de espera, uma única requisição
+    de teste (half-open) decide se ele fecha ou abre de novo.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, url, min_limit, max_limit, latency_target,
+                 failure_threshold, cooldown):
+        self.url = url
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.latency_target = latency_target
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.limit = float(self.min_limit)
+        self.state = self.CLOSED
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self._opened_until = 0.0
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        self.successes = 0
+        self.failures = 0
+        self.opens = 0
+        self.retry_after_waits = 0
+
+    def available_in(self):
+        """Segundos até que uma nova requisição possa ser feita (0 = agora)"""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now < self._opened_until:
+                return max(self._opened_until, self._blocked_until) - now
+            self.state = self.HALF_OPEN
+            delivery_logger.info(f"Circuito do webhook {self.url} meio-aberto: enviando teste")
+        return max(self._blocked_until - now, 0.0)
+
+    async def acquire(self):
+        """Aguarda uma vaga; retorna False se o webhook ficou bloqueado enquanto aguardava"""
+        async with self._cond:
+            while True:
+                if self.available_in() > 0:
+                    return False
+                limit = 1 if self.state == self.HALF_OPEN else int(self.limit)
+                if self.in_flight < limit:
+                    self.in_flight += 1
+                    return True
+                await self._cond.wait()
+
+    async def release(self, latency=None, status=None, retry_after=None):
+        """Registra o resultado de uma requisição (status None = sucesso)
+
+        status 'aborted' apenas libera a vaga, sem afetar o estado do webhook.
+        """
+        async with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status == 'aborted':
+                pass
+            elif status is None:
+                self.successes += 1
+                self.consecutive_failures = 0
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    delivery_logger.info(f"Circuito do webhook {self.url} fechado")
+                if latency is not None and latency > self.latency_target:
+                    self._decrease(now)
+                elif self.limit < self.max_limit:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif status == 'error' or status >= 500 or status in (408, 429):
+                self.failures += 1
+                self.consecutive_failures += 1
+                self._decrease(now)
+                if retry_after is not None:
+                    self.retry_after_waits += 1
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+                if (self.state == self.HALF_OPEN
+                        or self.consecutive_failures >= self.failure_threshold):
+                    self._open(now)
+            elif self.state == self.HALF_OPEN:
+                # Erro 4xx do payload: o webhook respondeu, então está no ar
+                self.state = self.CLOSED
+            self._cond.notify_all()
+
+    def _decrease(self, now):
+        # No máximo uma redução por janela de latência, para não zerar o limite em rajadas
+        if now - self._last_decrease >= self.latency_target:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self._last_decrease = now
+
+    def _open(self, now):
+        if self.state != self.OPEN:
+            self.opens += 1
+            delivery_logger.warning(
+                f"Circuito do webhook {self.url} aberto após "
+                f"{self.consecutive_failures} falhas; nova tentativa em {self.cooldown:g}s")
+        self.state = self.OPEN
+        self._opened_until = now + self.cooldown
+        self.limit = float(self.min_limit)
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'consecutive_failures': self.consecutive_failures,
+            'blocked_for': round(self.available_in(), 1),
+            'successes': self.successes,
+            'failures': self.failures,
+            'opens': self.opens,
+            'retry_after_waits': self.retry_after_waits,
+        }
+
+
+class WebhookTargets:
+    """Estado (concorrência e circuito) de cada webhook, criado sob demanda"""
+
+    def __init__(self, **options):
+        self.options = options
+        self._targets = {}
+
+    def get(self, url):
+        target = self._targets.get(url)
+        if target is None:
+            target = self._targets[url] = WebhookTarget(url, **self.options)
+        return target
+
+    def __iter__(self):
+        return iter(self._targets.values())
+
+    def stats(self):
+        return {url: target.stats() for url, target in self._targets.items()}
+
+
+class DeliveryItem:
+    """Payload a entregar em um webhook de destino
+
+    Na fila fica apenas o payload serializado (body, compartilhado entre os destinos)
+    e os campos usados na entrega; o dict original, com o base64 da mídia, não é
+    mantido, para que cada item ocupe em memória só o tamanho do body.
+    """
+
+    __slots__ = ('seq', 'target', 'body', 'key', 'chat_key', 'batchable',
+                 'received_at', 'enqueued_at')
+
+    def __init__(self, target, data, batchable=False, seq=None, received_at=None, body=None):
+        self.seq = seq
+        self.target = target
+        self.body = body if body is not None else encode_json(data)
+        self.key = data.get('idempotency_key')
+        self.chat_key = Outbox.chat_key(data)
+        self.batchable = batchable
+        # Instantes (monotônicos) do recebimento no Telegram e da entrada na fila
+        self.received_at = received_at
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def data(self):
+        """Payload decodificado a partir do body (usado apenas fora do caminho de entrega)"""
+        return json.loads(self.body)
+
+    def to_dict(self):
+        return {'seq': self.seq, 'target': self.target,
+                'data': self.data, 'batchable': self.batchable}
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry['target'], entry['data'], entry['batchable'], entry['seq'])
+
+
+class Outbox:
+    """Caixa de saída persistente (SQLite em modo WAL) para os payloads do webhook"""
+
+    def __init__(self, path, commit_interval=0.05, commit_batch=200):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._conn = None
+        self._uncommitted = 0
+        self._pending_acks = []
+        self._flush_task = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        # auto_vacuum só tem efeito se definido antes da criação das tabelas
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Em WAL, synchronous=NORMAL só faz fsync nos checkpoints (fsync em lote)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "chat_key TEXT NOT NULL, "
+            "target TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "batchable INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL)")
+        # Payloads recusados definitivamente pelo webhook (4xx), guardados para análise
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letter ("
+            "seq INTEGER PRIMARY KEY, "
+            "chat_key TEXT NOT NULL, "
+            "target TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "batchable INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, "
+            "rejected_at REAL NOT NULL)")
+        self._conn.execute("BEGIN")
+        delivery_logger.info(f"Outbox aberto em: {self.path} ({self.pending_count()} pendentes)")
+
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        if self._conn is not None:
+            self.flush()
+            self._conn.execute("COMMIT")
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def chat_key(data):
+        return str(data.get('chat_id', data.get('group_id', '')))
+
+    def append(self, item):
+        """Registra o item antes da entrega e devolve o número de sequência"""
+        cursor = self._conn.execute(
+            "INSERT INTO outbox (chat_key, target, payload, batchable, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (item.chat_key, item.target, item.body,
+             int(item.batchable), time.time()))
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_batch:
+            self.flush()
+        return cursor.lastrowid
+
+    def ack(self, seq):
+        """Marca o payload como entregue (removido no próximo commit)"""
+        self._pending_acks.append(seq)
+
+    def dead_letter(self, seq):
+        """Move o payload para a tabela dead_letter: não volta a ser reenviado"""
+        self.flush()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO dead_letter "
+            "(seq, chat_key, target, payload, batchable, created_at, rejected_at) "
+            "SELECT seq, chat_key, target, payload, batchable, created_at, ? "
+            "FROM outbox WHERE seq = ?", (time.time(), seq))
+        self._conn.execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+        self._uncommitted += 1
+
+    def flush(self):
+        """Commit em grupo das inserções e confirmações acumuladas"""
+        if self._pending_acks:
+            self._conn.executemany(
+                "DELETE FROM outbox WHERE seq = ?",
+                [(seq,) for seq in self._pending_acks])
+            self._pending_acks = []
+            self._uncommitted += 1
+        if self._uncommitted:
+            self._conn.execute("COMMIT")
+            self._conn.execute("BEGIN")
+            self._uncommitted = 0
+
+    def compact(self):
+        """Devolve páginas livres ao disco e trunca o arquivo WAL"""
+        self.flush()
+        self._conn.execute("COMMIT")
+        try:
+            self._conn.execute("PRAGMA incremental_vacuum")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            self._conn.execute("BEGIN")
+
+    def pending(self, exclude=()):
+        """Itens ainda não confirmados, em ordem de gravação, como (chat_key, item)"""
+        self.flush()
+        rows = self._conn.execute(
+            "SELECT seq, chat_key, target, payload, batchable FROM outbox ORDER BY seq").fetchall()
+        items = []
+        for seq, chat_key, target, payload, batchable in rows:
+            if seq in exclude:
+                continue
+            # Registros antigos guardam o JSON como texto
+            body = payload.encode('utf-8') if isinstance(payload, str) else payload
+            items.append((chat_key, DeliveryItem(
+                target, json.loads(body), bool(batchable), seq, body=body)))
+        return items
+
+    def pending_count(self):
+        self.flush()
+        return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.commit_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                delivery_logger.error(f"Erro ao gravar outbox: {e}", exc_info=True)
+
+
+class DeliveryQueue:
+    """Fila limitada com workers que entregam os payloads ao webhook"""
+
+    POLICIES = ('block', 'drop_oldest', 'spill')
+
+    # Resultado da entrega de cada payload
+    DELIVERED = 'delivered'
+    FAILED = 'failed'      # falha temporária: permanece no outbox para o redrive
+    REJECTED = 'rejected'  # recusa definitiva (4xx): vai para o dead letter
+
+    @staticmethod
+    def is_rejection(status):
+        """4xx não se resolve com nova tentativa, exceto 408 (timeout) e 429 (limite)"""
+        return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+    def __init__(self, webhook, maxsize, workers, policy='block',
+                 spill_path=None, max_retries=3, outbox=None, targets=None,
+                 batch_size=1, batch_window=0.5, batch_max_bytes=16 * 1024 * 1024):
+        if policy not in self.POLICIES:
+            delivery_logger.warning(
+                f"Política de fila desconhecida '{policy}', usando 'block'")
+            policy = 'block'
+        if policy == 'spill' and not spill_path:
+            raise ValueError("DELIVERY_SPILL_PATH é obrigatório com a política 'spill'")
+        self.webhook = webhook
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.spill_path = spill_path
+        self.max_retries = max_retries
+        self.outbox = outbox
+        self.targets = targets if targets is not None else webhook_targets
+        self.batch_size = max(batch_size, 1)
+        self.batch_window = batch_window
+        self.batch_max_bytes = batch_max_bytes
+        self._queue = None
+        self._tasks = []
+        self._busy = 0
+        self._busy_time = 0.0
+        self._stats_since = time.monotonic()
+        self._spill_pending = 0
+        # Sequências do outbox que já estão na fila ou em entrega
+        self._inflight = set()
+        self._replay_lock = asyncio.Lock()
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.batches = 0
+        self.parked = 0
+        self.last_stats = {}
+
+    def start(self):
+        """Cria a fila e inicia os workers no loop atual"""
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._stats_since = time.monotonic()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+        if self.policy == 'spill':
+            if self.outbox is not None:
+                # Com outbox, tudo que estava em disco será reenviado pelo replay
+                for path in (self.spill_path, f"{self.spill_path}.processing"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            elif os.path.exists(self.spill_path):
+                self._spill_pending = 1
+            self._tasks.append(asyncio.create_task(self._refill_from_spill()))
+        delivery_logger.info(
+            f"Fila de entrega iniciada: {self.workers} workers, "
+            f"capacidade {self.maxsize}, política '{self.policy}'")
+        if self.batch_size > 1:
+            delivery_logger.info(
+                f"Entrega em lote ativa: até {self.batch_size} mensagens, "
+                f"{self.batch_window * 1000:.0f} ms ou {self.batch_max_bytes} bytes")
+
+    async def join(self):
+        """Aguarda até que todos os itens enfileirados tenham sido processados"""
+        await self._queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, target, data, batchable=False, received_at=None, body=None):
+        """Enfileira um payload para o webhook target aplicando a política de contrapressão
+
+        Payloads marcados como batchable podem ser agrupados com outros no modo lote.
+        received_at é o instante de recebimento da mensagem (métrica end_to_end).
+        body é o payload já serializado, compartilhado entre os destinos.
+        """
+        self.enqueued += 1
+        item = DeliveryItem(target, data, batchable, received_at=received_at, body=body)
+        if self.outbox is not None:
+            item.seq = self.outbox.append(item)
+            self._inflight.add(item.seq)
+        if self.policy == 'block':
+            await self._queue.put(item)
+        elif self.policy == 'drop_oldest':
+            if self._queue.full():
+                try:
+                    dropped = self._queue.get_nowait()
+                    self._queue.task_done()
+                    # Continua no outbox e será reenviado pelo redrive
+                    self._inflight.discard(dropped.seq)
+                    self.dropped += 1
+                    delivery_logger.warning("Fila de entrega cheia: payload mais antigo descartado")
+                except asyncio.QueueEmpty:
+                    pass
+            self._queue.put_nowait(item)
+        else:
+            # Mantém a ordem: enquanto houver itens em disco, novos itens também vão para o disco
+            if self._queue.full() or self._spill_pending:
+                self._spill(item)
+            else:
+                self._queue.put_nowait(item)
+
+    def _spill(self, item):
+        with open(self.spill_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(item.to_dict(), default=str) + '\n')
+        self._spill_pending += 1
+        self.spilled += 1
+
+    async def _refill_from_spill(self):
+        """Devolve para a fila os payloads gravados em disco quando houver espaço"""
+        processing_path = f"{self.spill_path}.processing"
+        while True:
+            await asyncio.sleep(1)
+            if not os.path.exists(processing_path):
+                if not self._spill_pending or self._queue.full():
+                    continue
+                if not os.path.exists(self.spill_path):
+                    self._spill_pending = 0
+                    continue
+                # Novos transbordos passam a ir para um arquivo novo
+                os.replace(self.spill_path, processing_path)
+                self._spill_pending = 0
+            try:
+                with open(processing_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            await self._queue.put(DeliveryItem.from_dict(json.loads(line)))
+                os.remove(processing_path)
+            except Exception as e:
+                delivery_logger.error(f"Erro ao reprocessar payloads em disco: {e}", exc_info=True)
+
+    async def _worker(self, worker_id):
+        # Itens já retirados da fila que não couberam no lote atual (outro destino, limite de bytes)
+        pending = deque()
+        while True:
+            item = pending.popleft() if pending else await self._queue.get()
+            items = [item]
+            if self.batch_size > 1 and item.batchable:
+                await self._collect_batch(items, pending)
+            self._busy += 1
+            started = time.monotonic()
+            for queued in items:
+                STAGE_SECONDS.observe(started - queued.enqueued_at, stage='queue_wait')
+            try:
+                results = await self._deliver_items(items)
+                if self.outbox is not None:
+                    for done, result in zip(items, results):
+                        self._settle(done, result)
+            except Exception as e:
+                delivery_logger.error(f"Erro no worker de entrega {worker_id}: {e}", exc_info=True)
+            finally:
+                self._busy -= 1
+                self._busy_time += time.monotonic() - started
+                for done in items:
+                    # Sem confirmação o payload permanece no outbox para o redrive
+                    self._inflight.discard(done.seq)
+                    self._queue.task_done()
+
+    async def _collect_batch(self, items, pending):
+        """Acumula itens do mesmo destino até o tamanho, a janela de tempo ou o limite de bytes
+
+        Itens de outros destinos retirados da fila vão para pending, preservando a ordem
+        de cada destino.
+        """
+        target = items[0].target
+        size = len(items[0].body)
+
+        def accept(item):
+            nonlocal size
+            item_size = len(item.body)
+            if size + item_size + 2 > self.batch_max_bytes:
+                return False
+            items.append(item)
+            size += item_size + 1
+            return True
+
+        # Primeiro os itens do mesmo destino que já estavam aguardando
+        for item in list(pending):
+            if len(items) >= self.batch_size:
+                return
+            if item.target != target:
+                continue
+            if not item.batchable or not accept(item):
+                return
+            pending.remove(item)
+
+        deadline = time.monotonic() + self.batch_window
+        while len(items) < self.batch_size and len(pending) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item.target != target:
+                pending.append(item)
+            elif not item.batchable or not accept(item):
+                pending.append(item)
+                break
+
+    def _chunk(self, entries):
+        """Divide itens do mesmo destino em lotes respeitando os limites"""
+        batch, size = [], 0
+        for entry in entries:
+            entry_size = len(entry.body) if self.batch_size > 1 else 0
+            fits = (batch and entry.batchable and batch[-1].batchable
+                    and len(batch) < self.batch_size
+                    and size + entry_size + 2 <= self.batch_max_bytes)
+            if batch and not fits:
+                yield batch
+                batch, size = [], 0
+            batch.append(entry)
+            size += entry_size + 1
+        if batch:
+            yield batch
+
+    def _settle(self, item, result):
+        """Registra no outbox o resultado da entrega (FAILED continua pendente)"""
+        if result == self.DELIVERED:
+            self.outbox.ack(item.seq)
+        elif result == self.REJECTED:
+            self.outbox.dead_letter(item.seq)
+
+    async def _deliver_items(self, items):
+        """Entrega os itens (um ou um lote) e devolve o resultado de cada um, na ordem"""
+        target = items[0].target
+        if len(items) == 1:
+            result = await self._deliver(target, items[0].body, [items[0].key])
+        else:
+            self.batches += 1
+            # O corpo do lote é montado a partir dos bytes já serializados de cada item
+            body = b'[' + b','.join(item.body for item in items) + b']'
+            result = await self._deliver(target, body, [item.key for item in items])
+            if result == self.REJECTED:
+                # Lote recusado: reenvia um a um para isolar os payloads recusados
+                delivery_logger.warning(
+                    "Lote de %d mensagens recusado por %s; reenviando individualmente",
+                    len(items), target)
+                results = []
+                for item in items:
+                    if results and results[-1] == self.FAILED:
+                        # Mantém a ordem: o restante aguarda o redrive
+                        results.append(self.FAILED)
+                        continue
+                    results.append(await self._deliver(target, item.body, [item.key]))
+                self._observe_end_to_end(items, results)
+                return results
+        results = [result] * len(items)
+        self._observe_end_to_end(items, results)
+        return results
+
+    def _observe_end_to_end(self, items, results):
+        now = time.monotonic()
+        for item, result in zip(items, results):
+            if result == self.DELIVERED and item.received_at is not None:
+                STAGE_SECONDS.observe(now - item.received_at, stage='end_to_end')
+
+    async def _deliver(self, target, body, keys):
+        """Envia o payload serializado (ou lote) com retry e espera exponencial
+
+        keys são as idempotency_key dos payloads incluídos no body.
+
+        Com o circuito do webhook aberto (ou durante um Retry-After) o payload fica
+        estacionado no outbox para o redrive, sem gastar tentativas; sem outbox, o
+        worker aguarda o webhook ser liberado. Uma resposta 4xx definitiva (exceto
+        408/429) encerra as tentativas com REJECTED.
+        """
+        state = self.targets.get(target)
+        count = len(keys)
+        attempt = 0
+        while attempt < self.max_retries:
+            wait = state.available_in()
+            if wait <= 0 and await state.acquire():
+                wait = 0
+            elif wait <= 0:
+                # Bloqueado enquanto aguardava a vaga
+                wait = state.available_in() or 0.1
+            if wait:
+                if self.outbox is not None:
+                    self.parked += count
+                    delivery_logger.debug(
+                        "Webhook %s indisponível: payload mantido no outbox", target)
+                    return self.FAILED
+                await asyncio.sleep(wait)
+                continue
+            if attempt:
+                WEBHOOK_RETRIES.inc()
+            started = time.monotonic()
+            try:
+                # Formatação lazy: nada é serializado para log abaixo de DEBUG
+                delivery_logger.debug("Tentando enviar para webhook: %s", target)
+                if delivery_logger.isEnabledFor(logging.DEBUG):
+                    delivery_logger.debug(
+                        "Dados a serem enviados: %s", summarize_payload(None, body))
+                # Lança exceção para códigos de erro HTTP
+                response = await self.webhook.post(
+                    target, body, raise_for_status=True, headers=self._headers(keys))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                elapsed = time.monotonic() - started
+                status = getattr(e, 'status', 'error')
+                retry_after = None
+                if status in (429, 503):
+                    headers = getattr(e, 'headers', None) or {}
+                    retry_after = parse_retry_after(headers.get('Retry-After'))
+                await state.release(elapsed, status=status, retry_after=retry_after)
+                WEBHOOK_REQUEST_SECONDS.observe(elapsed)
+                WEBHOOK_RESPONSES.inc(status=status)
+                if self.is_rejection(status):
+                    if count == 1:
+                        delivery_logger.error(
+                            "Webhook %s recusou o payload (%s); não será reenviado: %s",
+                            target, status, summarize_payload(None, body))
+                        self.rejected += 1
+                    return self.REJECTED
+                delivery_logger.warning(
+                    "Tentativa %d/%d falhou: %s", attempt + 1, self.max_retries, e)
+                attempt += 1
+                if attempt < self.max_retries and retry_after is None:
+                    await asyncio.sleep(2 ** (attempt - 1))  # Espera exponencial
+                continue
+            except Exception:
+                # Erro inesperado (não é falha do webhook): libera a vaga e propaga
+                await state.release(status='aborted')
+                raise
+            elapsed = time.monotonic() - started
+            await state.release(elapsed)
+            WEBHOOK_REQUEST_SECONDS.observe(elapsed)
+            WEBHOOK_RESPONSES.inc(status=response.status_code)
+            if count > 1:
+                delivery_logger.info(
+                    "Lote de %d mensagens encaminhado com sucesso. Status: %s",
+                    count, response.status_code)
+            else:
+                delivery_logger.info(
+                    "Mensagem encaminhada com sucesso. Status: %s", response.status_code)
+            delivery_logger.debug("Resposta do webhook: %.200s", response.text)
+            self.delivered += count
+            return self.DELIVERED
+        delivery_logger.error(
+            f"Falha ao enviar para webhook após {self.max_retries} tentativas")
+        self.failed += count
+        return self.FAILED
+
+    @staticmethod
+    def _headers(keys):
+        """Cabeçalho Idempotency-Key: a chave da mensagem ou, num lote, o hash das chaves"""
+        if len(keys) == 1:
+            key = keys[0]
+        else:
+            key = (hashlib.sha256(','.join(keys).encode('utf-8')).hexdigest()
+                   if all(keys) else None)
+        return {'Idempotency-Key': key} if key else None
+
+    async def replay(self):
+        """Reenvia os payloads não confirmados do outbox, mantendo a ordem por chat e destino"""
+        if self.outbox is None:
+            return
+        async with self._replay_lock:
+            by_chat = {}
+            for chat_key, item in self.outbox.pending(exclude=self._inflight):
+                by_chat.setdefault((chat_key, item.target), []).append(item)
+                self._inflight.add(item.seq)
+            if not by_chat:
+                return
+            total = sum(len(entries) for entries in by_chat.values())
+            delivery_logger.info(f"Reenviando {total} payloads pendentes do outbox ({len(by_chat)} chats/destinos)")
+            # Cada chat/destino é entregue em sequência; os demais em paralelo
+            limit = asyncio.Semaphore(self.workers)
+
+            async def replay_chat(entries):
+                async with limit:
+                    done = 0
+                    for batch in self._chunk(entries):
+                        for item, result in zip(batch, await self._deliver_items(batch)):
+                            if result == self.FAILED:
+                                # Interrompe o chat para não entregar fora de ordem
+                                for pending in entries[done:]:
+                                    self._inflight.discard(pending.seq)
+                                return
+                            # Payloads recusados (dead letter) não bloqueiam os seguintes
+                            self._settle(item, result)
+                            self._inflight.discard(item.seq)
+                            done += 1
+                            if result == self.DELIVERED:
+                                self.replayed += 1
+
+            await asyncio.gather(*(replay_chat(entries) for entries in by_chat.values()))
+
+    async def redrive_loop(self, interval, compact_interval):
+        """Reenvio periódico do outbox (falhas anteriores) e compactação"""
+        last_compact = time.monotonic()
+        while True:
+            try:
+                await self.replay()
+                if time.monotonic() - last_compact >= compact_interval:
+                    self.outbox.compact()
+                    last_compact = time.monotonic()
+            except Exception as e:
+                delivery_logger.error(f"Erro no reenvio do outbox: {e}", exc_info=True)
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        """Profundidade da fila e utilização dos workers desde a última leitura"""
+        now = time.monotonic()
+        elapsed = max(now - self._stats_since, 1e-9)
+        utilization = min(self._busy_time / (elapsed * self.workers), 1.0)
+        self._busy_time = 0.0
+        self._stats_since = now
+        stats = {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'queue_capacity': self.maxsize,
+            'spill_pending': self._spill_pending,
+            'workers': self.workers,
+            'workers_busy': self._busy,
+            'worker_utilization': round(utilization, 3),
+            'enqueued': self.enqueued,
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'replayed': self.replayed,
+            'batches': self.batches,
+            'parked': self.parked,
+            'webhooks': self.targets.stats(),
+        }
+        if self.outbox is not None:
+            stats['outbox_pending'] = self.outbox.pending_count()
+        self.last_stats = stats
+        return stats
+
+
+PRIORITY_HIGH = 0  # processamento de mensagens de texto (remetente, chat)
+PRIORITY_LOW = 1   # downloads de mídia e tarefas em segundo plano
+
+
+class TelegramRateLimiter:
+    """Token bucket adaptativo para as requisições MTProto
+
+    Todas as chamadas ao Telegram passam por aqui: a taxa cai pela metade a cada
+    FloodWait (com pausa pelo tempo pedido pelo Telegram) e volta a subir aos poucos
+    após sucessos. Requisições de maior prioridade são atendidas primeiro e o número
+    de downloads simultâneos é limitado.
+    """
+
+    def __init__(self, rate, min_rate, burst, max_downloads, recovery_step=0.05):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = burst
+        self.recovery_step = recovery_step
+        self.max_downloads = max_downloads
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._cond = asyncio.Condition()
+        self._downloads = asyncio.Semaphore(max_downloads)
+        self.downloads_active = 0
+        self.requests = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self, priority=PRIORITY_HIGH):
+        """Aguarda um token respeitando pausas de FloodWait e a ordem de prioridade"""
+        entry = (priority, next(self._counter))
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = None
+                    if self._waiters[0] == entry:
+                        delay = self._paused_until - now
+                        if delay <= 0 and self._tokens >= 1:
+                            self._tokens -= 1
+                            heapq.heappop(self._waiters)
+                            self.requests += 1
+                            self._cond.notify_all()
+                            return
+                        if delay <= 0:
+                            delay = (1 - self._tokens) / self.rate
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+    def on_flood_wait(self, seconds):
+        """Pausa todas as requisições pelo tempo pedido e reduz a taxa"""
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning(
+            f"FloodWait de {seconds}s do Telegram; taxa reduzida para {self.rate:.2f} req/s")
+
+    async def call(self, func, *args, priority=PRIORITY_HIGH, max_attempts=3, **kwargs):
+        """Executa uma chamada ao Telegram sob o limitador, repetindo após FloodWait"""
+        for attempt in range(max_attempts):
+            await self.acquire(priority)
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.on_flood_wait(e.seconds)
+                if attempt == max_attempts - 1:
+                    raise
+                continue
+            self.on_success()
+            return result
+
+    @contextlib.asynccontextmanager
+    async def download_slot(self):
+        """Limita os downloads de mídia simultâneos"""
+        async with self._downloads:
+            self.downloads_active += 1
+            try:
+                yield
+            finally:
+                self.downloads_active -= 1
+
+    def stats(self):
+        self._refill(time.monotonic())
+        waiting = [priority for priority, _ in self._waiters]
+        return {
+            'rate': round(self.rate, 3),
+            'max_rate': self.max_rate,
+            'tokens': round(self._tokens, 2),
+            'paused_for': round(max(self._paused_until - time.monotonic(), 0), 1),
+            'waiting_high': waiting.count(PRIORITY_HIGH),
+            'waiting_low': waiting.count(PRIORITY_LOW),
+            'downloads_active': self.downloads_active,
+            'max_downloads': self.max_downloads,
+            'requests': self.requests,
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+        }
+
+
+class FloodSleepObserver(logging.Filter):
+    """Repassa ao limitador os FloodWait que o Telethon aguarda internamente
+
+    Esperas até TELEGRAM_FLOOD_SLEEP_THRESHOLD não chegam como exceção (inclusive nas
+    atualizações e no iter_messages); o Telethon apenas registra "Sleeping for Ns ... on
+    X flood wait" em telethon.client.users. O logger passa a emitir INFO para que o
+    filtro veja o registro, que só segue para a saída no nível configurado antes.
+    """
+
+    LOGGER = 'telethon.client.users'
+
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+        self.output_level = logging.getLogger(self.LOGGER).getEffectiveLevel()
+
+    def filter(self, record):
+        # Esperas "early" repetem um FloodWait já contado para a mesma requisição
+        if (isinstance(record.msg, str) and record.msg.endswith('flood wait')
+                and record.args and not record.args[0]):
+            self.limiter.on_flood_wait(record.args[1])
+        return record.levelno >= self.output_level
+
+    def install(self):
+        telethon_logger = logging.getLogger(self.LOGGER)
+        telethon_logger.addFilter(self)
+        telethon_logger.setLevel(min(self.output_level, logging.INFO))
+
+
+class MediaSpool:
+    """Cache de mídias em disco, endereçado por conteúdo e servido via HTTP local
+
+    Os arquivos são baixados por partes e gravados como <sha256>.<ext>. Um índice
+    persistente associa a identidade do arquivo no Telegram (id da foto/documento)
+    ao conteúdo, então reenvios e encaminhamentos da mesma mídia não são baixados
+    de novo. O espaço em disco é limitado por max_bytes com descarte LRU.
+
+    Arquivos até inline_max_bytes continuam indo em base64 no payload; os maiores
+    são enviados ao webhook apenas como referência (URL, tamanho, mime e hash).
+    """
+
+    NAME_PATTERN = re.compile(r'^[0-9a-f]{64}(\.[A-Za-z0-9]{1,10})?$')
+
+    def __init__(self, directory, inline_max_bytes, public_url, max_bytes):
+        self.directory = directory
+        self.inline_max_bytes = inline_max_bytes
+        self.public_url = public_url.rstrip('/')
+        self.max_bytes = max_bytes
+        self._conn = None
+        # file_key -> (nome do arquivo, tamanho), em ordem de uso (LRU)
+        self._entries = OrderedDict()
+        # nome do arquivo -> quantidade de chaves que apontam para ele
+        self._refs = {}
+        self._total_bytes = 0
+        self._downloading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(self.directory, 'index.db'), isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_index ("
+            "file_key TEXT PRIMARY KEY, "
+            "name TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL)")
+        rows = self._conn.execute(
+            "SELECT file_key, name, size FROM media_index ORDER BY last_used").fetchall()
+        for file_key, name, size in rows:
+            if os.path.isfile(os.path.join(self.directory, name)):
+                self._add_entry(file_key, name, size)
+            else:
+                self._conn.execute("DELETE FROM media_index WHERE file_key = ?", (file_key,))
+        # Remove downloads interrompidos e arquivos fora do índice
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and (entry.name.endswith('.part')
+                                    or (self.NAME_PATTERN.match(entry.name)
+                                        and entry.name not in self._refs)):
+                os.remove(entry.path)
+        self._evict()
+        media_logger.info(
+            f"Cache de mídia em {self.directory}: {len(self._entries)} arquivos, "
+            f"{self._total_bytes} bytes (limite {self.max_bytes})")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def path_for(self, name):
+        if not self.NAME_PATTERN.match(name):
+            return None
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def file_key(message):
+        """Identidade estável do arquivo no Telegram (a mesma em encaminhamentos)"""
+        if message.photo is not None:
+            return f"photo:{message.photo.id}"
+        if message.document is not None:
+            return f"document:{message.document.id}"
+        return None
+
+    def _add_entry(self, file_key, name, size):
+        self._entries[file_key] = (name, size)
+        if name not in self._refs:
+            self._refs[name] = 0
+            self._total_bytes += size
+        self._refs[name] += 1
+
+    def _evict(self):
+        """Descarta as entradas menos usadas até caber no limite de espaço"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            file_key, (name, size) = self._entries.popitem(last=False)
+            self._conn.execute("DELETE FROM media_index WHERE file_key = ?", (file_key,))
+            self._refs[name] -= 1
+            if self._refs[name] == 0:
+                del self._refs[name]
+                self._total_bytes -= size
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                self.evictions += 1
+
+    def _lookup(self, file_key):
+        entry = self._entries.get(file_key)
+        if entry is None:
+            return None
+        if not os.path.isfile(os.path.join(self.directory, entry[0])):
+            # Arquivo removido externamente: trata como ausente
+            self._entries.pop(file_key)
+            self._refs[entry[0]] -= 1
+            if self._refs[entry[0]] == 0:
+                del self._refs[entry[0]]
+                self._total_bytes -= entry[1]
+            self._conn.execute("DELETE FROM media_index WHERE file_key = ?", (file_key,))
+            return None
+        self._entries.move_to_end(file_key)
+        self._conn.execute(
+            "UPDATE media_index SET last_used = ? WHERE file_key = ?", (time.time(), file_key))
+        return entry
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(MEDIA_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    async def _download(self, message, file_key, file_ext):
+        """Baixa a mídia por partes para o disco e registra no índice"""
+        tmp_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.part")
+        try:
+            async with rate_limiter.download_slot():
+                await rate_limiter.call(
+                    message.download_media, file=tmp_path, priority=PRIORITY_LOW)
+            size = os.path.getsize(tmp_path)
+            sha256 = await asyncio.to_thread(self._hash_file, tmp_path)
+            name = f"{sha256}.{file_ext}" if file_ext and file_ext.isalnum() else sha256
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if file_key is None:
+            # Sem identidade estável no Telegram: indexado pelo conteúdo, para que o
+            # arquivo conte no limite de espaço e seja descartado como os demais
+            file_key = f"content:{name}"
+        self._conn.execute(
+            "INSERT OR REPLACE INTO media_index (file_key, name, size, last_used) "
+            "VALUES (?, ?, ?, ?)", (file_key, name, size, time.time()))
+        if file_key not in self._entries:
+            self._add_entry(file_key, name, size)
+        else:
+            self._entries.move_to_end(file_key)
+        self._evict()
+        media_logger.debug("Mídia de %d bytes gravada em disco: %s", size, name)
+        return name, size
+
+    def _fields(self, name, size):
+        sha256 = name.split('.')[0]
+        if size <= self.inline_max_bytes:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                media_base64 = base64.b64encode(f.read()).decode('utf-8')
+            return {
+                'media_delivery': 'inline',
+                'media_size': size,
+                'media_sha256': sha256,
+                'media_base64': media_base64,
+            }
+        return {
+            'media_delivery': 'url',
+            'media_size': size,
+            'media_sha256': sha256,
+            'media_url': f"{self.public_url}/media/{name}",
+        }
+
+    async def fetch(self, message, file_ext=None):
+        """Obtém a mídia da mensagem (do cache ou do Telegram) e devolve os campos do payload"""
+        file_key = self.file_key(message)
+        entry = self._lookup(file_key) if file_key is not None else None
+        cache_hit = entry is not None
+        if entry is None:
+            # Downloads simultâneos do mesmo arquivo compartilham a mesma tarefa
+            task = self._downloading.get(file_key) if file_key is not None else None
+            if task is None:
+                self.misses += 1
+                task = asyncio.ensure_future(self._download(message, file_key, file_ext))
+                if file_key is not None:
+                    self._downloading[file_key] = task
+                    task.add_done_callback(lambda _: self._downloading.pop(file_key, None))
+            else:
+                self.hits += 1
+                cache_hit = True
+            entry = await asyncio.shield(task)
+        else:
+            self.hits += 1
+        fields = self._fields(*entry)
+        fields['media_cache_hit'] = cache_hit
+        return fields
+
+    def stats(self):
+        return {
+            'files': len(self._refs),
+            'bytes': self._total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+async def serve_media(request):
+    """Entrega um arquivo do spool de mídia (GET /media/{name})"""
+    path = media_spool.path_for(request.match_info['name'])
+    if path is None or not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    return web.FileResponse(path)
+
+
+async def serve_metrics(request):
+    """Métricas no formato do Prometheus (GET /metrics)"""
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+
+async def serve_reload(request):
+    """Recarrega o arquivo de rotas (POST /admin/reload, Authorization: Bearer <ADMIN_TOKEN>)"""
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {ADMIN_TOKEN}".encode('utf-8')):
+        raise web.HTTPUnauthorized()
+    try:
+        summary = await reload_routes()
+    except Exception as e:
+        return web.json_response({'status': 'error', 'error': str(e)}, status=400)
+    return web.json_response({'status': 'ok', **summary})
+
+
+async def start_http_server():
+    """Servidor HTTP local: mídias grandes, métricas e recarga da configuração"""
+    app = web.Application()
+    app.router.add_get('/media/{name}', serve_media)
+    app.router.add_get('/metrics', serve_metrics)
+    if ADMIN_TOKEN:
+        app.router.add_post('/admin/reload', serve_reload)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, HTTP_HOST, HTTP_PORT)
+    await site.start()
+    logger.info(f"Servidor HTTP local ouvindo em {HTTP_HOST}:{HTTP_PORT}")
+    return runner
+
+
+def normalize_chat_id(chat_id):
+    """Reduz os formatos de ID de chat (-100..., negativo, positivo) ao ID base"""
+    chat_id = abs(int(chat_id))
+    # IDs de supergrupos/canais "marcados" têm o prefixo -100 (10^12)
+    if chat_id >= 1000000000000:
+        chat_id -= 1000000000000
+    return chat_id
+
+
+class Route:
+    """Rota: chats de origem, webhooks de destino e filtros opcionais"""
+
+    def __init__(self, name, chats, webhooks, is_bot=None, has_media=None, text_regex=None):
+        if not chats or not webhooks:
+            raise ValueError(f"Rota '{name}' precisa de ao menos um chat e um webhook")
+        self.name = name
+        self.chats = [int(chat_id) for chat_id in chats]
+        self.webhooks = list(webhooks)
+        self.is_bot = is_bot
+        self.has_media = has_media
+        self.text_pattern = re.compile(text_regex) if text_regex else None
+
+    def matches(self, message, sender):
+        """Aplica os filtros da rota à mensagem"""
+        if self.is_bot is not None and bool(getattr(sender, 'bot', False)) != self.is_bot:
+            return False
+        if self.has_media is not None and bool(message.media) != self.has_media:
+            return False
+        if self.text_pattern is not None and not self.text_pattern.search(message.text or ''):
+            return False
+        return True
+
+
+class RoutingTable:
+    """Índice chat -> rotas, compilado na inicialização para busca O(1) por mensagem"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        # ID normalizado do chat -> (ID configurado, rotas)
+        self._index = {}
+        for route in routes:
+            for chat_id in route.chats:
+                key = normalize_chat_id(chat_id)
+                self._index.setdefault(key, (chat_id, []))[1].append(route)
+
+    def lookup(self, chat_key):
+        return self._index.get(chat_key)
+
+    @property
+    def chat_ids(self):
+        return [configured for configured, _ in self._index.values()]
+
+    @property
+    def webhooks(self):
+        return list(dict.fromkeys(url for route in self.routes for url in route.webhooks))
+
+    @staticmethod
+    def targets(routes, message, sender):
+        """Webhooks (sem repetição) das rotas cujos filtros aceitam a mensagem"""
+        targets = {}
+        for route in routes:
+            if route.matches(message, sender):
+                for url in route.webhooks:
+                    targets.setdefault(url, route.name)
+        return list(targets)
+
+    @staticmethod
+    def all_targets(routes):
+        """Todos os webhooks (sem repetição) das rotas, sem aplicar filtros"""
+        return list(dict.fromkeys(url for route in routes for url in route.webhooks))
+
+
+def load_routing_table(path=None):
+    """Carrega as rotas do arquivo (YAML ou JSON) ou de GROUP_ID/WEBHOOK_URL"""
+    if not path:
+        if GROUP_ID is None or not WEBHOOK_URL:
+            raise ValueError("Defina GROUP_ID e WEBHOOK_URL ou um arquivo de rotas em ROUTES_FILE")
+        return RoutingTable([Route('default', [GROUP_ID], [WEBHOOK_URL])])
+
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise RuntimeError("PyYAML não está instalado; use um arquivo de rotas JSON")
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    routes = []
+    for i, entry in enumerate(config.get('routes', [])):
+        filters = entry.get('filters') or {}
+        routes.append(Route(
+            name=entry.get('name', f"rota_{i + 1}"),
+            chats=entry.get('chats', []),
+            webhooks=entry.get('webhooks', []),
+            is_bot=filters.get('is_bot'),
+            has_media=filters.get('has_media'),
+            text_regex=filters.get('text_regex'),
+        ))
+    if not routes:
+        raise ValueError(f"Nenhuma rota definida em {path}")
+    return RoutingTable(routes)
+
+
+class CachedEntity:
+    """Dados mínimos de um usuário ou chat usados nos payloads"""
+
+    __slots__ = ('id', 'first_name', 'last_name', 'username', 'bot', 'title',
+                 'entity_type', 'expires_at', '_sender_fields', '_chat_fields')
+
+    def __init__(self, entity, expires_at):
+        self.id = entity.id
+        self.first_name = getattr(entity, 'first_name', None)
+        self.last_name = getattr(entity, 'last_name', None)
+        self.username = getattr(entity, 'username', None)
+        self.bot = bool(getattr(entity, 'bot', False))
+        self.title = getattr(entity, 'title', None)
+        self.entity_type = type(entity).__name__
+        self.expires_at = expires_at
+        self._sender_fields = None
+        self._chat_fields = None
+
+    def sender_fields(self):
+        """Campos do remetente no payload, montados uma vez por entrada do cache"""
+        if self._sender_fields is None:
+            self._sender_fields = {
+                'sender_id': self.id,
+                'sender_name': f"{self.first_name or ''} {self.last_name or ''}",
+                'sender_username': self.username,
+                'is_bot': self.bot,
+            }
+        return self._sender_fields
+
+    def chat_fields(self):
+        """Campos do chat no payload, montados uma vez por entrada do cache"""
+        if self._chat_fields is None:
+            self._chat_fields = {'chat_title': self.title, 'chat_type': self.entity_type}
+        return self._chat_fields
+
+
+# Campos usados quando o remetente ou o chat não puderam ser obtidos
+NO_SENDER_FIELDS = {'sender_id': None, 'sender_name': ' ', 'sender_username': '', 'is_bot': False}
+NO_CHAT_FIELDS = {'chat_title': None, 'chat_type': None}
+
+
+class EntityCache:
+    """Cache LRU com TTL de remetentes e chats, evitando get_sender/get_chat por mensagem"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # (tipo, id) -> CachedEntity, em ordem de uso
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("/app/logs/telegram_forwarder.log")
-    ]
-)
-logger = logging.getLogger(__name__)
+    def _put(self, key, entity):
+        entry = CachedEntity(entity, time.monotonic() + self.ttl)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
 
-# Habilitar logs detalhados da biblioteca Telethon
-telethon_logger = logging.getLogger("telethon")
-telethon_logger.setLevel(logging.DEBUG)
+    def put_user(self, entity):
+        return self._put(('user', entity.id), entity)
 
-# Iniciar cliente
-# Definir caminho absoluto para o arquivo de sessão
-SESSION_PATH = '/app/telegram_session/telegram_session'
+    def put_chat(self, chat_key, entity):
+        return self._put(('chat', chat_key), entity)
 
-# Iniciar cliente com caminho absoluto
-client = TelegramClient(SESSION_PATH, API_ID, API_HASH)
-logger.info(f"Usando arquivo de sessão em: {SESSION_PATH}")
+    async def get_sender(self, event):
+        """Remetente da mensagem, buscando no Telegram apenas em caso de ausência"""
+        sender_id = event.sender_id
+        if sender_id is None:
+            return None
+        entry = self._get(('user', sender_id))
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        sender = await rate_limiter.call(event.get_sender)
+        return self._put(('user', sender_id), sender) if sender is not None else None
 
-@client.on(events.NewMessage(chats=GROUP_ID, incoming=True, outgoing=True))
-async def handler(event):
-    """Captura todas as mensagens do grupo e encaminha para o webhook"""
-    try:
-        # Adicione logs detalhados
-        logger.debug(f"================================")
-        logger.debug(f"Nova mensagem detectada! Event ID: {id(event)}")
-        logger.debug(f"Tipo do evento: {type(event).__name__}")
+    async def get_chat(self, event, chat_key):
+        """Chat da mensagem, buscando no Telegram apenas em caso de ausência"""
+        entry = self._get(('chat', chat_key))
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        chat = await rate_limiter.call(event.get_chat)
+        return self.put_chat(chat_key, chat) if chat is not None else None
 
-        # Obter detalhes da mensagem
-        message = event.message
-        logger.debug(f"Message ID: {message.id}")
-        logger.debug(f"Message text: {message.text or '[Sem texto]'}")
-        logger.debug(f"Message date: {message.date}")
-        logger.debug(f"Has media: {bool(message.media)}")
+    def invalidate_user(self, user_id):
+        if self._entries.pop(('user', user_id), None) is not None:
+            self.invalidations += 1
 
-        sender = await event.get_sender()
-        logger.debug(f"Sender ID: {sender.id}")
-        logger.debug(
-            f"Sender name: {getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '')}")
-        logger.debug(f"Is bot: {getattr(sender, 'bot', False)}")
+    def invalidate_chat(self, chat_key):
+        if self._entries.pop(('chat', chat_key), None) is not None:
+            self.invalidations += 1
 
-        # Data e hora formatada
-        timestamp = datetime.now().isoformat()
+    async def prefill(self, client, chat_ids, participants_limit):
+        """Carrega os chats monitorados e seus participantes antes das primeiras mensagens"""
+        for chat_id in chat_ids:
+            try:
+                chat = await rate_limiter.call(
+                    client.get_entity, chat_id, priority=PRIORITY_LOW)
+                self.put_chat(normalize_chat_id(chat_id), chat)
+                if participants_limit <= 0:
+                    continue
+                count = 0
+                async for user in client.iter_participants(chat, limit=participants_limit):
+                    self.put_user(user)
+                    count += 1
+                logger.info(f"Cache de entidades: {count} participantes carregados do chat {chat_id}")
+            except Exception as e:
+                logger.warning(f"Não foi possível pré-carregar entidades do chat {chat_id}: {e}")
 
-        # Preparar dados para enviar
-        data = {
-            'message_id': message.id,
-            'date': message.date.isoformat(),
-            'text': message.text or '',
-            'sender_id': sender.id,
-            'sender_name': f"{getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '') or ''}",
-            'sender_username': getattr(sender, 'username', ''),
-            'is_bot': getattr(sender, 'bot', False),
-            'group_id': GROUP_ID,
-            'has_media': bool(message.media),
-            'captured_at': timestamp
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
         }
 
-        # Processar mídia de forma mais completa
-        if message.media:
+
+# Estado dos componentes lido no momento da coleta das métricas
+for _name, _help, _type, _callback in (
+    ('delivery_queue_depth', 'Payloads aguardando na fila de entrega', 'gauge',
+     lambda: delivery_queue._queue.qsize() if delivery_queue._queue else 0),
+    ('delivery_workers_busy', 'Workers de entrega ocupados', 'gauge',
+     lambda: delivery_queue._busy),
+    ('delivery_delivered_total', 'Payloads entregues ao webhook', 'counter',
+     lambda: delivery_queue.delivered),
+    ('delivery_failed_total', 'Payloads que esgotaram as tentativas', 'counter',
+     lambda: delivery_queue.failed),
+    ('delivery_rejected_total', 'Payloads recusados pelo webhook (4xx) e movidos para o dead letter',
+     'counter', lambda: delivery_queue.rejected),
+    ('delivery_dropped_total', 'Payloads descartados da fila (drop_oldest)', 'counter',
+     lambda: delivery_queue.dropped),
+    ('delivery_parked_total', 'Payloads mantidos no outbox com o webhook indisponível', 'counter',
+     lambda: delivery_queue.parked),
+    ('webhook_circuits_open', 'Webhooks com o circuito aberto ou meio-aberto', 'gauge',
+     lambda: sum(target.state != WebhookTarget.CLOSED for target in webhook_targets)),
+    ('webhook_concurrency_limit', 'Soma dos limites de concorrência dos webhooks', 'gauge',
+     lambda: sum(int(target.limit) for target in webhook_targets)),
+    ('outbox_pending', 'Payloads não confirmados no outbox', 'gauge',
+     lambda: outbox.pending_count() if outbox is not None and outbox._conn else 0),
+    ('media_cache_bytes', 'Bytes ocupados pelo cache de mídia', 'gauge',
+     lambda: media_spool._total_bytes),
+    ('media_cache_hits_total', 'Mídias servidas do cache', 'counter',
+     lambda: media_spool.hits),
+    ('media_cache_misses_total', 'Mídias baixadas do Telegram', 'counter',
+     lambda: media_spool.misses),
+    ('telegram_rate', 'Taxa atual permitida de requisições ao Telegram (req/s)', 'gauge',
+     lambda: rate_limiter.rate),
+    ('telegram_requests_total', 'Requisições ao Telegram liberadas pelo limitador', 'counter',
+     lambda: rate_limiter.requests),
+    ('telegram_flood_waits_total', 'FloodWaits recebidos do Telegram', 'counter',
+     lambda: rate_limiter.flood_waits),
+    ('telegram_waiting_requests', 'Requisições aguardando o limitador', 'gauge',
+     lambda: len(rate_limiter._waiters)),
+    ('media_downloads_active', 'Downloads de mídia em andamento', 'gauge',
+     lambda: rate_limiter.downloads_active),
+    ('dedup_suppressed_total', 'Mensagens duplicadas descartadas antes da entrega', 'counter',
+     lambda: dedup_index.suppressed),
+    ('dedup_index_size', 'Chaves mantidas no índice de duplicados', 'gauge',
+     lambda: len(dedup_index._seen)),
+    ('edits_received_total', 'Edições de mensagens recebidas', 'counter',
+     lambda: edit_coalescer.received),
+    ('edits_coalesced_total', 'Edições agrupadas com outra edição pendente', 'counter',
+     lambda: edit_coalescer.coalesced),
+    ('album_parts_total', 'Partes de álbuns recebidas', 'counter',
+     lambda: album_aggregator.parts),
+    ('albums_total', 'Álbuns encaminhados como um único evento', 'counter',
+     lambda: album_aggregator.albums),
+    ('shard_owned_chats', 'Chats encaminhados por esta instância (sharding)', 'gauge',
+     lambda: len(shard._owned) if shard.store is not None else len(routing_table.chat_ids)),
+    ('entity_cache_hits_total', 'Remetentes/chats servidos do cache', 'counter',
+     lambda: entity_cache.hits),
+    ('entity_cache_misses_total', 'Remetentes/chats buscados no Telegram', 'counter',
+     lambda: entity_cache.misses),
+):
+    metrics.register(CallbackMetric(f"telegram_forwarder_{_name}", _help, _type, _callback))
+
+
+class ChatStateStore:
+    """Último message_id encaminhado por chat, persistido para o catch-up após quedas
+
+    O ID registrado só avança sobre uma sequência contínua: enquanto uma mensagem
+    estiver em andamento (ex.: baixando mídia), as mais novas já concluídas não passam
+    à frente dela, senão uma queda nesse intervalo a deixaria fora do catch-up.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = None
+        self._last_ids = {}
+        # chat_key -> {message_id: ocorrências em andamento}
+        self._in_flight = {}
+        # chat_key -> maior message_id já processado
+        self._done = {}
+        self._dirty = set()
+        self._flush_task = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_state ("
+            "chat_key INTEGER PRIMARY KEY, "
+            "last_message_id INTEGER NOT NULL)")
+        self._last_ids = dict(self._conn.execute(
+            "SELECT chat_key, last_message_id FROM chat_state").fetchall())
+
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def get(self, chat_key):
+        return self._last_ids.get(chat_key)
+
+    def begin(self, chat_key, message_ids):
+        """Marca as mensagens como em andamento (antes de qualquer await)"""
+        in_flight = self._in_flight.setdefault(chat_key, {})
+        for message_id in message_ids:
+            in_flight[message_id] = in_flight.get(message_id, 0) + 1
+
+    def finish(self, chat_key, message_ids, processed=True):
+        """Conclui as mensagens; processed indica que foram enfileiradas ou descartadas
+        pelos filtros (com erro, não contam como processadas)"""
+        in_flight = self._in_flight.get(chat_key, {})
+        for message_id in message_ids:
+            count = in_flight.get(message_id, 0) - 1
+            if count > 0:
+                in_flight[message_id] = count
+            else:
+                in_flight.pop(message_id, None)
+        if not in_flight:
+            self._in_flight.pop(chat_key, None)
+        if processed and message_ids:
+            self._done[chat_key] = max(self._done.get(chat_key, 0), max(message_ids))
+        last_id = self._done.get(chat_key)
+        if last_id is None:
+            return
+        if in_flight:
+            last_id = min(last_id, min(in_flight) - 1)
+        if last_id > self._last_ids.get(chat_key, 0):
+            self._last_ids[chat_key] = last_id
+            self._dirty.add(chat_key)
+
+    @contextlib.contextmanager
+    def tracking(self, chat_key, message_ids, enabled=True):
+        """Mantém as mensagens em andamento durante o bloco"""
+        if not enabled:
+            yield
+            return
+        self.begin(chat_key, message_ids)
+        processed = False
+        try:
+            yield
+            processed = True
+        finally:
+            self.finish(chat_key, message_ids, processed)
+
+    def flush(self):
+        if not self._dirty:
+            return
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO chat_state (chat_key, last_message_id) VALUES (?, ?)",
+            [(chat_key, self._last_ids[chat_key]) for chat_key in self._dirty])
+        self._dirty.clear()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
             try:
-                # Identificar o tipo de mídia
-                media_type = "unknown"
-                media_details = {}
-                
-                # Foto
-                if hasattr(message.media, 'photo'):
-                    media_type = "photo"
-                
-                # Documento
-                elif hasattr(message.media, 'document'):
-                    media_type = "document"
-                    if hasattr(message.media.document, 'mime_type'):
-                        media_details['mime_type'] = message.media.document.mime_type
-                    if hasattr(message.media.document, 'filename'):
-                        media_details['filename'] = message.media.document.filename
-                
-                # Localização
-                elif hasattr(message.media, 'geo'):
-                    media_type = "location"
-                    media_details['latitude'] = message.media.geo.lat
-                    media_details['longitude'] = message.media.geo.long
-                
-                # Contato
-                elif hasattr(message.media, 'phone_number'):
-                    media_type = "contact"
-                    media_details['phone'] = message.media.phone_number
-                    if hasattr(message.media, 'first_name'):
-                        media_details['first_name'] = message.media.first_name
-                
-                # URL
-                elif hasattr(message.media, 'webpage'):
-                    media_type = "webpage"
-                    if hasattr(message.media.webpage, 'url'):
-                        media_details['url'] = message.media.webpage.url
-                    if hasattr(message.media.webpage, 'title'):
-                        media_details['title'] = message.media.webpage.title
-                
-                # Adicionar aos dados
-                data['media_type'] = media_type
-                data['media_details'] = media_details
-                
+                self.flush()
             except Exception as e:
-                logger.error(f"Erro ao processar mídia: {e}", exc_info=True)
-                data['media_error'] = str(e)
+                logger.error(f"Erro ao gravar estado dos chats: {e}", exc_info=True)
+
+
+def idempotency_key(chat_key, message_id, version=0):
+    """Chave estável de uma versão de mensagem: chat, message_id e versão de edição"""
+    return f"{chat_key}:{message_id}:{version}"
+
+
+def edit_timestamp(message):
+    """Timestamp da última edição da mensagem (0 se nunca editada)"""
+    edit_date = getattr(message, 'edit_date', None)
+    return edit_date.timestamp() if edit_date else 0
+
+
+def message_version(message):
+    """Versão de edição da mensagem (0 se nunca editada)
+
+    O edit_date tem resolução de um segundo: a versão inclui um hash do texto e da
+    mídia para que duas edições no mesmo segundo não compartilhem a chave.
+    """
+    edit_date = getattr(message, 'edit_date', None)
+    if not edit_date:
+        return 0
+    content = f"{message.text or ''}\0{MediaSpool.file_key(message) or ''}"
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+    return f"{int(edit_date.timestamp())}-{digest}"
+
 
-        # Enviar para webhook com retry
-        max_retries = 3
-        for attempt in range(max_retries):
+class DedupIndex:
+    """Índice limitado das chaves de idempotência vistas na janela de tempo
+
+    Repetições (atualizações reenviadas após reconexões, catch-up sobreposto) são
+    descartadas antes da entrega. Com path, as chaves sobrevivem a reinícios.
+    """
+
+    def __init__(self, window, max_entries, path=None, flush_interval=1.0):
+        self.window = window
+        self.max_entries = max_entries
+        self.path = path
+        self.flush_interval = flush_interval
+        self._seen = OrderedDict()
+        self._new = []
+        self._conn = None
+        self._flush_task = None
+        self.suppressed = 0
+
+    def open(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dedup ("
+            "key TEXT PRIMARY KEY, "
+            "seen_at REAL NOT NULL)")
+        self._conn.execute("DELETE FROM dedup WHERE seen_at < ?", (time.time() - self.window,))
+        rows = self._conn.execute(
+            "SELECT key, seen_at FROM dedup ORDER BY seen_at DESC LIMIT ?",
+            (self.max_entries,)).fetchall()
+        for key, seen_at in reversed(rows):
+            self._seen[key] = seen_at
+
+    def start(self):
+        if self._conn is not None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def add(self, key):
+        """Reserva a chave; retorna False se ela já foi vista dentro da janela
+
+        A reserva fica só em memória: é gravada no banco por confirm, depois que a
+        entrega foi enfileirada, ou esquecida por discard se isso falhar.
+        """
+        now = time.time()
+        self._expire(now)
+        if key in self._seen:
+            self.suppressed += 1
+            return False
+        self._seen[key] = now
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+        return True
+
+    def confirm(self, key):
+        """Marca a chave para gravação (a entrega já está na fila/outbox)"""
+        if self._conn is not None:
+            self._new.append((key, self._seen.get(key, time.time())))
+
+    def discard(self, key):
+        """Esquece a chave (a entrega não chegou a ser enfileirada)"""
+        self._seen.pop(key, None)
+
+    def _expire(self, now):
+        # Inserção em ordem cronológica: as chaves mais antigas estão no início
+        limit = now - self.window
+        while self._seen and next(iter(self._seen.values())) < limit:
+            self._seen.popitem(last=False)
+
+    def flush(self):
+        if not self._new:
+            return
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO dedup (key, seen_at) VALUES (?, ?)", self._new)
+        self._new = []
+        self._conn.execute("DELETE FROM dedup WHERE seen_at < ?", (time.time() - self.window,))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
             try:
-                logger.debug(f"Tentando enviar para webhook: {WEBHOOK_URL}")
-                logger.debug(
-                    f"Dados a serem enviados: {json.dumps(data, default=str)}")
-                response = requests.post(WEBHOOK_URL, json=data, timeout=10)
-                response.raise_for_status()  # Lança exceção para códigos de erro HTTP
-                logger.info(
-                    f"Mensagem encaminhada com sucesso. Status: {response.status_code}")
-                logger.debug(f"Resposta do webhook: {response.text[:200]}")
-                break  # Sai do loop se bem-sucedido
-            except requests.exceptions.RequestException as e:
-                logger.warning(
-                    f"Tentativa {attempt+1}/{max_retries} falhou: {e}")
-                if attempt == max_retries - 1:  # Última tentativa
-                    logger.error(
-                        f"Falha ao enviar para webhook após {max_retries} tentativas")
-                else:
-                    await asyncio.sleep(2 ** attempt)  # Espera exponencial
-
-        # Log para debug
-        logger.info(f"Mensagem capturada: {data.get('text')[:100]}...")
+                self.flush()
+            except Exception as e:
+                logger.error(f"Erro ao gravar índice de duplicados: {e}", exc_info=True)
 
-    except Exception as e:
-        logger.error(f"Erro ao processar mensagem: {e}", exc_info=True)
+    def stats(self):
+        return {'size': len(self._seen), 'suppressed': self.suppressed}
+
+
+class ShardLeaseStore:
+    """Leases dos chats monitorados, compartilhados entre as instâncias em um banco SQLite
+
+    Cada instância mantém um heartbeat e leases com validade ttl. Os chats são
+    divididos igualmente entre as instâncias vivas; o lease guarda também o último
+    message_id encaminhado, usado pelo novo dono para o catch-up após uma falha.
+    Outro armazenamento (Redis, etcd) pode substituí-lo implementando sync e release.
+    """
+
+    def __init__(self, path, instance_id, ttl):
+        self.path = path
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self._conn = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Sem WAL: o arquivo pode estar em um volume compartilhado entre containers;
+        # as chamadas vêm de threads auxiliares, uma de cada vez
+        self._conn = sqlite3.connect(
+            self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS instances ("
+            "instance_id TEXT PRIMARY KEY, "
+            "expires_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "chat_key INTEGER PRIMARY KEY, "
+            "owner TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, "
+            "last_message_id INTEGER)")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _score(self, chat_key):
+        # Rendezvous hashing: cada chat tem uma ordem de preferência estável entre instâncias
+        return hashlib.sha1(f"{self.instance_id}:{chat_key}".encode('utf-8')).digest()
+
+    def sync(self, chat_keys, progress):
+        """Renova heartbeat e leases, libera o excedente e assume chats livres
+
+        progress traz o último message_id encaminhado de cada chat desta instância.
+        Retorna {chat_key: last_message_id registrado} dos chats desta instância.
+        """
+        now = time.time()
+        expires_at = now + self.ttl
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO instances (instance_id, expires_at) VALUES (?, ?)",
+                (self.instance_id, expires_at))
+            conn.execute("DELETE FROM instances WHERE expires_at < ?", (now - self.ttl,))
+            live = conn.execute(
+                "SELECT COUNT(*) FROM instances WHERE expires_at > ?", (now,)).fetchone()[0]
+            quota = -(-len(chat_keys) // max(live, 1))
+            leases = {chat_key: (owner, lease_expires, last_id) for chat_key, owner, lease_expires, last_id
+                      in conn.execute("SELECT chat_key, owner, expires_at, last_message_id FROM leases")}
+
+            owned, free = [], []
+            for chat_key in chat_keys:
+                owner, lease_expires, _ = leases.get(chat_key, (None, 0, None))
+                if owner == self.instance_id and lease_expires > now:
+                    owned.append(chat_key)
+                elif lease_expires <= now:
+                    free.append(chat_key)
+            owned.sort(key=self._score, reverse=True)
+            free.sort(key=self._score, reverse=True)
+            # Uma nova instância reduz a cota: o excedente é liberado para ela
+            released = owned[quota:]
+            owned = owned[:quota] + free[:max(quota - len(owned), 0)]
+
+            for chat_key in released:
+                conn.execute(
+                    "UPDATE leases SET expires_at = 0, "
+                    "last_message_id = MAX(COALESCE(last_message_id, 0), COALESCE(?, 0)) "
+                    "WHERE chat_key = ? AND owner = ?",
+                    (progress.get(chat_key), chat_key, self.instance_id))
+            result = {}
+            for chat_key in owned:
+                last_id = leases.get(chat_key, (None, 0, None))[2]
+                if progress.get(chat_key) is not None:
+                    last_id = max(last_id or 0, progress[chat_key])
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (chat_key, owner, expires_at, last_message_id) "
+                    "VALUES (?, ?, ?, ?)", (chat_key, self.instance_id, expires_at, last_id))
+                result[chat_key] = last_id
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def release(self, progress):
+        """Libera todos os leases desta instância (encerramento) preservando o progresso"""
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for chat_key, last_id in progress.items():
+                if last_id is not None:
+                    conn.execute(
+                        "UPDATE leases SET last_message_id = MAX(COALESCE(last_message_id, 0), ?) "
+                        "WHERE chat_key = ? AND owner = ?", (last_id, chat_key, self.instance_id))
+            conn.execute("UPDATE leases SET expires_at = 0 WHERE owner = ?", (self.instance_id,))
+            conn.execute("DELETE FROM instances WHERE instance_id = ?", (self.instance_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class ShardCoordinator:
+    """Decide quais chats esta instância encaminha quando o sharding está ativo
+
+    Sem store (sharding desativado), todos os chats são desta instância; com store,
+    nenhum é até start() obter os leases.
+    """
+
+    def __init__(self, store, renew_interval):
+        self.store = store
+        self.renew_interval = renew_interval
+        self.active = False
+        self._owned = {}
+        self._valid_until = 0.0
+        self._task = None
+        # Renovação periódica e recarga das rotas não sincronizam ao mesmo tempo
+        self._lock = asyncio.Lock()
+        self.gained = 0
+        self.lost = 0
 
+    def owns(self, chat_key):
+        if self.store is None:
+            return True
+        if not self.active:
+            return False
+        # O lease só vale até a última renovação + ttl, mesmo sem conseguir renovar
+        return chat_key in self._owned and time.time() < self._valid_until
 
-# Handler global para todos os eventos em todos os chats
-@client.on(events.NewMessage())
-async def global_handler(event):
+    def last_message_id(self, chat_key):
+        return self._owned.get(chat_key)
+
+    def _progress(self):
+        return {chat_key: chat_state.get(chat_key) for chat_key in self._owned}
+
+    async def sync(self):
+        """Sincroniza com o store e devolve {chat_key: último ID} dos chats assumidos nesta rodada
+
+        O último ID (maior entre o lease e o estado local) é lido antes de o chat passar
+        a ser desta instância, então mensagens ao vivo não escondem a lacuna do catch-up.
+        """
+        async with self._lock:
+            started = time.time()
+            chat_keys = sorted({normalize_chat_id(chat_id) for chat_id in routing_table.chat_ids})
+            owned = await asyncio.to_thread(self.store.sync, chat_keys, self._progress())
+            self._valid_until = started + self.store.ttl
+            gained = {}
+            for chat_key, last_id in owned.items():
+                if chat_key not in self._owned:
+                    known = [i for i in (last_id, chat_state.get(chat_key)) if i is not None]
+                    gained[chat_key] = max(known) if known else None
+            lost = set(self._owned) - set(owned)
+            self._owned = owned
+            self.gained += len(gained)
+            self.lost += len(lost)
+        if gained or lost:
+            logger.info(
+                f"Sharding ({self.store.instance_id}): assumiu {sorted(gained)}, "
+                f"liberou {sorted(lost)}; chats desta instância: {sorted(owned)}")
+        return gained
+
+    async def start(self, on_gained=None):
+        """Primeira sincronização e renovação periódica
+
+        Devolve {chat_key: último ID} dos chats obtidos; on_gained(chat_key, last_id) é
+        chamado para cada chat assumido nas renovações seguintes.
+        """
+        self.store.open()
+        gained = await self.sync()
+        self.active = True
+        self._task = asyncio.create_task(self._run(on_gained))
+        return gained
+
+    async def _run(self, on_gained):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                gained = await self.sync()
+                if on_gained is not None:
+                    for chat_key, last_id in gained.items():
+                        spawn(on_gained(chat_key, last_id))
+            except Exception as e:
+                logger.error(f"Erro ao renovar os leases do sharding: {e}", exc_info=True)
+
+    async def stop_renewal(self):
+        """Para a renovação periódica; os leases continuam válidos até expirar ou close()"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def close(self):
+        await self.stop_renewal()
+        if self.active:
+            try:
+                await asyncio.to_thread(self.store.release, self._progress())
+            except Exception as e:
+                logger.error(f"Erro ao liberar os leases do sharding: {e}", exc_info=True)
+            self.active = False
+        if self.store is not None:
+            self.store.close()
+
+    def stats(self):
+        if self.store is None:
+            return {'enabled': False}
+        return {
+            'instance_id': self.store.instance_id,
+            'owned_chats': sorted(self._owned) if self.active else None,
+            'gained': self.gained,
+            'lost': self.lost,
+        }
+
+
+async def extract_media(message):
+    """Identifica o tipo de mídia e baixa fotos/documentos (base64 ou referência)"""
+    media_type = "unknown"
+    media_details = {}
+    mime_type = None
+    file_ext = None
+    media_fields = {}
+    media = message.media
     try:
-        chat = await event.get_chat()
-        sender = await event.get_sender()
-        
-        logger.debug(f"==== GLOBAL HANDLER ACIONADO ====")
-        logger.debug(f"Chat ID: {chat.id}, Tipo: {type(chat).__name__}")
-        logger.debug(f"Mensagem: {event.message.text[:50] if event.message.text else '[Sem texto]'}")
-        logger.debug(f"Remetente: {getattr(sender, 'first_name', '') or 'Unknown'} (ID: {sender.id}, Bot: {getattr(sender, 'bot', False)})")
-        logger.debug(f"GROUP_ID definido: {GROUP_ID}")
-        
-        # SOLUÇÃO: Comparar ignorando o sinal (positivo/negativo)
-        is_target_group_ignoring_sign = abs(chat.id) == abs(GROUP_ID)
-        logger.debug(f"É o grupo alvo (ignorando sinal)? {is_target_group_ignoring_sign}")
-        
-        # Tentativa normal
-        logger.debug(f"É o grupo alvo (comparação exata)? {chat.id == GROUP_ID}")
-        
-        # Tente outros formatos do GROUP_ID
-        group_id_alt = str(GROUP_ID).replace('-100', '')
-        group_id_alt = group_id_alt.replace('-', '')  # Remover qualquer sinal negativo
-        logger.debug(f"Alternativa 1: {abs(chat.id) == int(group_id_alt) if group_id_alt.isdigit() else False}")
-        
-        # Verificar os possíveis formatos do ID do grupo
-        target_group_ids = [
-            GROUP_ID, 
-            -GROUP_ID,  # Versão com sinal trocado
-            abs(GROUP_ID),  # Versão absoluta
-            -abs(GROUP_ID),  # Versão absoluta negativa
-            int(group_id_alt) if group_id_alt.isdigit() else 0
-        ]
-        
-        # Se for o grupo alvo em qualquer formato, envie para o webhook
-        if abs(chat.id) == abs(GROUP_ID) or chat.id in target_group_ids:
-            logger.debug(f"🚨 CORRESPONDÊNCIA ENCONTRADA! Mensagem do grupo alvo detectada!")
-            
-            # Coletar informações adicionais para diagnóstico
-            message_info = ""
-            if event.message.text:
-                message_info = event.message.text[:200]
-            elif hasattr(event.message, 'media') and event.message.media:
-                message_info = f"[Mensagem com mídia: {type(event.message.media).__name__}]"
-            else:
-                message_info = "[Sem texto ou mídia]"
-                
-            # Verificar se tem botões
-            has_buttons = False
-            buttons_info = ""
-            if hasattr(event.message, 'buttons') and event.message.buttons:
-                has_buttons = True
-                buttons_info = str(event.message.buttons)
-            
-            # Processar mídia de forma mais completa
-            media_type = "none"
-            media_details = {}
-            media_base64 = None
-            mime_type = None
-            file_ext = None
-            
-            if hasattr(event.message, 'media') and event.message.media:
-                try:
-                    # Identificar o tipo de mídia
-                    media_type = "unknown"
-                    
-                    # Foto
-                    if hasattr(event.message.media, 'photo'):
-                        media_type = "photo"
-                        mime_type = "image/jpeg"
-                        file_ext = "jpg"
-                        
-                        # Baixar a foto
-                        logger.debug(f"Baixando foto do Telegram...")
-                        media_bytes = await event.message.download_media(bytes)
-                        
-                        # Converter para Base64
-                        import base64
-                        media_base64 = base64.b64encode(media_bytes).decode('utf-8')
-                        logger.debug(f"Foto convertida para Base64 ({len(media_base64)} caracteres)")
-                    
-                    # Documento
-                    elif hasattr(event.message.media, 'document'):
-                        media_type = "document"
-                        if hasattr(event.message.media.document, 'mime_type'):
-                            mime_type = event.message.media.document.mime_type
-                            media_details['mime_type'] = mime_type
-                        if hasattr(event.message.media.document, 'filename'):
-                            filename = event.message.media.document.filename
-                            media_details['filename'] = filename
-                            if '.' in filename:
-                                file_ext = filename.split('.')[-1]
-                        
-                        # Baixar o documento
-                        logger.debug(f"Baixando documento do Telegram...")
-                        media_bytes = await event.message.download_media(bytes)
-                        
-                        # Converter para Base64
-                        import base64
-                        media_base64 = base64.b64encode(media_bytes).decode('utf-8')
-                        logger.debug(f"Documento convertido para Base64 ({len(media_base64)} caracteres)")
-                    
-                    # Localização
-                    elif hasattr(event.message.media, 'geo'):
-                        media_type = "location"
-                        media_details['latitude'] = event.message.media.geo.lat
-                        media_details['longitude'] = event.message.media.geo.long
-                    
-                    # Contato
-                    elif hasattr(event.message.media, 'phone_number'):
-                        media_type = "contact"
-                        media_details['phone'] = event.message.media.phone_number
-                        if hasattr(event.message.media, 'first_name'):
-                            media_details['first_name'] = event.message.media.first_name
-                    
-                    # URL
-                    elif hasattr(event.message.media, 'webpage'):
-                        media_type = "webpage"
-                        if hasattr(event.message.media.webpage, 'url'):
-                            media_details['url'] = event.message.media.webpage.url
-                        if hasattr(event.message.media.webpage, 'title'):
-                            media_details['title'] = event.message.media.webpage.title
-                    
-                except Exception as e:
-                    logger.error(f"Erro ao processar mídia: {e}", exc_info=True)
-                    media_details['error'] = str(e)
-            
-            # Enviar para o webhook
-            data = {
-                'event': 'group_message',
-                'timestamp': datetime.now().isoformat(),
-                'chat_id': chat.id,
-                'chat_id_abs': abs(chat.id),
-                'message_id': event.message.id,
-                'text': event.message.text or '',
-                'message_info': message_info,
-                'has_buttons': has_buttons,
-                'buttons_info': buttons_info[:100] if has_buttons else "",
-                'sender_id': sender.id,
-                'sender_name': f"{getattr(sender, 'first_name', '') or ''} {getattr(sender, 'last_name', '') or ''}",
-                'is_bot': getattr(sender, 'bot', False),
-                'match_type': 'abs_match' if abs(chat.id) == abs(GROUP_ID) else 'target_list_match',
-                'media_type': media_type,
-                'media_details': media_details
-            }
-            
-            # Adicionar base64 e mime_type se estiverem disponíveis
-            if media_base64:
-                data['media_base64'] = media_base64
-            if mime_type:
-                data['mime_type'] = mime_type
-            if file_ext:
-                data['file_ext'] = file_ext
-            
-            response = requests.post(WEBHOOK_URL, json=data, timeout=10)
-            logger.info(f"✅ Mensagem do grupo enviada para webhook: {response.status_code}")
-        
-        # Também envie um evento para o webhook mesmo que não seja do grupo alvo (para teste)
-        elif not is_target_group_ignoring_sign:
-            test_data = {
-                'event': 'other_chat_message',
-                'timestamp': datetime.now().isoformat(),
-                'chat_id': chat.id,
-                'chat_type': type(chat).__name__,
-                'message': event.message.text[:100] if event.message.text else '[Sem texto]',
-                'sender_id': sender.id,
-                'is_target_group': False
-            }
-            response = requests.post(WEBHOOK_URL, json=test_data, timeout=10)
-            logger.debug(f"Teste de webhook com mensagem de outro chat: {response.status_code}")
+        # Foto
+        if hasattr(media, 'photo'):
+            media_type = "photo"
+            mime_type = "image/jpeg"
+            file_ext = "jpg"
+
+            # Baixar a foto (base64 se pequena, URL local se grande)
+            media_logger.debug("Baixando foto do Telegram...")
+            started = time.monotonic()
+            media_fields = await media_spool.fetch(message, file_ext)
+            STAGE_SECONDS.observe(time.monotonic() - started, stage='media_download')
+            media_logger.debug("Foto processada (%s, %d bytes)",
+                               media_fields['media_delivery'], media_fields['media_size'])
+
+        # Documento
+        elif hasattr(media, 'document'):
+            media_type = "document"
+            if hasattr(media.document, 'mime_type'):
+                mime_type = media.document.mime_type
+                media_details['mime_type'] = mime_type
+            if hasattr(media.document, 'filename'):
+                filename = media.document.filename
+                media_details['filename'] = filename
+                if '.' in filename:
+                    file_ext = filename.split('.')[-1]
+
+            # Baixar o documento (base64 se pequeno, URL local se grande)
+            media_logger.debug("Baixando documento do Telegram...")
+            started = time.monotonic()
+            media_fields = await media_spool.fetch(message, file_ext)
+            STAGE_SECONDS.observe(time.monotonic() - started, stage='media_download')
+            media_logger.debug("Documento processado (%s, %d bytes)",
+                               media_fields['media_delivery'], media_fields['media_size'])
+
+        # Localização
+        elif hasattr(media, 'geo'):
+            media_type = "location"
+            media_details['latitude'] = media.geo.lat
+            media_details['longitude'] = media.geo.long
+
+        # Contato
+        elif hasattr(media, 'phone_number'):
+            media_type = "contact"
+            media_details['phone'] = media.phone_number
+            if hasattr(media, 'first_name'):
+                media_details['first_name'] = media.first_name
+
+        # URL
+        elif hasattr(media, 'webpage'):
+            media_type = "webpage"
+            if hasattr(media.webpage, 'url'):
+                media_details['url'] = media.webpage.url
+            if hasattr(media.webpage, 'title'):
+                media_details['title'] = media.webpage.title
+
     except Exception as e:
-        logger.error(f"Erro no handler global: {e}", exc_info=True)
+        media_logger.error(f"Erro ao processar mídia: {e}", exc_info=True)
+        media_details['error'] = str(e)
+
+    fields = {'media_type': media_type, 'media_details': media_details}
+    fields.update(media_fields)
+    if mime_type:
+        fields['mime_type'] = mime_type
+    if file_ext:
+        fields['file_ext'] = file_ext
+    return fields
+
+
+async def build_message_payload(message, chat_key, group_id, sender, chat=None):
+    """Monta o payload de uma mensagem do grupo monitorado"""
+    # Coletar informações adicionais para diagnóstico
+    if message.text:
+        message_info = message.text[:200]
+    elif message.media:
+        message_info = f"[Mensagem com mídia: {type(message.media).__name__}]"
+    else:
+        message_info = "[Sem texto ou mídia]"
+
+    # Verificar se tem botões
+    has_buttons = bool(getattr(message, 'buttons', None))
+
+    captured_at = datetime.now().isoformat()
+    data = {
+        'event': 'group_message',
+        'timestamp': captured_at,
+        'captured_at': captured_at,
+        'group_id': group_id,
+        'chat_id': chat_key,
+        'chat_id_abs': chat_key,
+        **(chat.chat_fields() if chat is not None else NO_CHAT_FIELDS),
+        'message_id': message.id,
+        'date': message.date.isoformat(),
+        'text': message.text or '',
+        'message_info': message_info,
+        'has_buttons': has_buttons,
+        'buttons_info': str(message.buttons)[:100] if has_buttons else "",
+        **(sender.sender_fields() if sender is not None else NO_SENDER_FIELDS),
+        'has_media': bool(message.media),
+        'media_type': 'none',
+        'media_details': {},
+    }
+
+    # Processar mídia de forma mais completa
+    if message.media:
+        data.update(await extract_media(message))
+    return data
+
+
+async def forward_message(message, chat_key, route_entry, received_at=None,
+                          extra=None, track_state=True, dedupe=True):
+    """Monta o payload de uma mensagem e enfileira para os webhooks das rotas
+
+    Usado tanto para mensagens novas quanto para o catch-up/exportação do histórico.
+    Com dedupe, versões de mensagem já encaminhadas dentro da janela são descartadas.
+    """
+    with chat_state.tracking(chat_key, [message.id], track_state):
+        group_id, routes = route_entry
+
+        # Filtros são aplicados antes de montar o payload (evita baixar mídia à toa)
+        sender = await entity_cache.get_sender(message)
+        targets = routing_table.targets(routes, message, sender)
+        if not targets:
+            logger.debug("Mensagem %s descartada pelos filtros das rotas", message.id)
+            return False
+        key = idempotency_key(chat_key, message.id, message_version(message))
+        if dedupe and not dedup_index.add(key):
+            logger.debug("Mensagem %s já encaminhada (%s); duplicado descartado", message.id, key)
+            return False
+        try:
+            chat = await entity_cache.get_chat(message, chat_key)
+            data = await build_message_payload(message, chat_key, group_id, sender, chat)
+            data['idempotency_key'] = key
+            if extra:
+                data.update(extra)
+            if received_at is not None:
+                STAGE_SECONDS.observe(time.monotonic() - received_at, stage='build')
+
+            # Enfileirar para entrega assíncrona (retry fica a cargo dos workers);
+            # o payload é serializado uma única vez para todos os destinos
+            body = encode_json(data)
+            for target in targets:
+                await delivery_queue.put(
+                    target, data, batchable=True, received_at=received_at, body=body)
+        except BaseException:
+            # Nada foi entregue: uma nova ocorrência da mensagem não deve ser descartada
+            dedup_index.discard(key)
+            raise
+        if dedupe:
+            dedup_index.confirm(key)
+    return True
+
+
+# Campos iguais em todas as partes de um álbum: ficam uma vez no evento, fora de items
+ALBUM_SHARED_FIELDS = ('event', 'timestamp', 'captured_at', 'group_id', 'chat_id', 'chat_id_abs',
+                       'chat_title', 'chat_type', 'sender_id', 'sender_name', 'sender_username',
+                       'is_bot')
+
+
+async def forward_album(messages, chat_key, route_entry, received_at=None,
+                        extra=None, track_state=True, dedupe=True):
+    """Encaminha as partes de um álbum (mesmo grouped_id) como um único evento
+
+    As mídias das partes são baixadas em paralelo, limitadas pelo limitador do Telegram.
+    """
+    with chat_state.tracking(chat_key, [message.id for message in messages], track_state):
+        group_id, routes = route_entry
+        messages = sorted(messages, key=lambda message: message.id)
+        first = messages[0]
+        sender = await entity_cache.get_sender(first)
+        targets = list(dict.fromkeys(
+            url for message in messages for url in routing_table.targets(routes, message, sender)))
+        if not targets:
+            logger.debug("Álbum %s descartado pelos filtros das rotas", first.grouped_id)
+            return False
+        message_ids = [message.id for message in messages]
+        key = idempotency_key(chat_key, ','.join(map(str, message_ids)), 'album')
+        if dedupe and not dedup_index.add(key):
+            logger.debug("Álbum %s já encaminhado (%s); duplicado descartado", first.grouped_id, key)
+            return False
+        try:
+            chat = await entity_cache.get_chat(first, chat_key)
+            parts = await asyncio.gather(*(
+                build_message_payload(message, chat_key, group_id, sender, chat)
+                for message in messages))
+            data = {field: parts[0][field] for field in ALBUM_SHARED_FIELDS}
+            data.update({
+                'event': 'album',
+                'grouped_id': first.grouped_id,
+                'message_id': first.id,
+                'message_ids': message_ids,
+                'date': parts[0]['date'],
+                # A legenda do álbum fica em uma das partes (normalmente a primeira)
+                'text': next((message.text for message in messages if message.text), ''),
+                'items': [{name: value for name, value in part.items()
+                           if name not in ALBUM_SHARED_FIELDS} for part in parts],
+                'idempotency_key': key,
+            })
+            if extra:
+                data.update(extra)
+            if received_at is not None:
+                STAGE_SECONDS.observe(time.monotonic() - received_at, stage='build')
+
+            body = encode_json(data)
+            for target in targets:
+                await delivery_queue.put(
+                    target, data, batchable=True, received_at=received_at, body=body)
+        except BaseException:
+            dedup_index.discard(key)
+            raise
+        if dedupe:
+            dedup_index.confirm(key)
+    return True
 
 
-# Handler mais abrangente para o grupo alvo
-@client.on(events.NewMessage)
-async def alternative_group_handler(event):
+class AlbumAggregator:
+    """Reúne as partes de um álbum, que o Telegram entrega como mensagens separadas
+
+    A primeira parte abre uma janela de window segundos; as partes com o mesmo
+    grouped_id recebidas nela são encaminhadas juntas.
+    """
+
+    def __init__(self, window, deliver):
+        self.window = window
+        self.deliver = deliver
+        # (chat_key, grouped_id) -> [mensagens, route_entry, received_at]
+        self._pending = {}
+        self._tasks = set()
+        self._flush_now = asyncio.Event()
+        self.parts = 0
+        self.albums = 0
+
+    async def submit(self, message, chat_key, route_entry, received_at=None):
+        self.parts += 1
+        key = (chat_key, message.grouped_id)
+        entry = self._pending.get(key)
+        if entry is not None:
+            entry[0].append(message)
+            return
+        self._pending[key] = [[message], route_entry, received_at]
+        task = asyncio.create_task(self._flush_later(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self, key):
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        messages, route_entry, received_at = self._pending.pop(key)
+        self.albums += 1
+        try:
+            await self.deliver(messages, key[0], route_entry, received_at)
+        except Exception as e:
+            logger.error(f"Erro ao encaminhar álbum {key[1]}: {e}", exc_info=True)
+
+    async def flush(self):
+        """Encaminha imediatamente os álbuns pendentes (usado no encerramento)"""
+        self._flush_now.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._flush_now.clear()
+
+    def stats(self):
+        return {'parts': self.parts, 'albums': self.albums, 'pending': len(self._pending)}
+
+
+async def forward_live_album(messages, chat_key, route_entry, received_at=None):
+    processed = False
     try:
-        chat = await event.get_chat()
-        
-        # Verificar se é o grupo alvo ignorando sinal (positivo/negativo)
-        if abs(chat.id) == abs(GROUP_ID):
-            logger.debug(f"HANDLER ALTERNATIVO: Mensagem detectada no grupo alvo via abs()!")
-            sender = await event.get_sender()
-            
-            # Enviar para o webhook
-            data = {
-                'event': 'group_message_via_alternative_handler',
-                'timestamp': datetime.now().isoformat(),
-                'chat_id': chat.id,
-                'message_id': event.message.id,
-                'text': event.message.text or '[Sem texto]',
-                'sender_id': sender.id,
-                'sender_name': f"{getattr(sender, 'first_name', '') or ''} {getattr(sender, 'last_name', '') or ''}",
-                'is_bot': getattr(sender, 'bot', False),
-                'match_type': 'alternative_abs_handler'
-            }
-            
-            response = requests.post(WEBHOOK_URL, json=data, timeout=10)
-            logger.debug(f"Mensagem do grupo enviada via handler alternativo: {response.status_code}")
-    except Exception as e:
-        logger.error(f"Erro no handler alternativo: {e}", exc_info=True)
+        if await forward_album(messages, chat_key, route_entry, received_at):
+            logger.info("Álbum capturado: %d itens", len(messages))
+        processed = True
+    finally:
+        # As partes estavam em andamento desde a chegada (dispatcher)
+        chat_state.finish(chat_key, [message.id for message in messages], processed)
 
 
-# Handler para qualquer tipo de evento no grupo
-@client.on(events.Raw)
-async def raw_handler(event):
+# Handler único para novas mensagens: resolve o chat uma vez e roteia por busca O(1).
+# A tabela de rotas é lida a cada evento, então uma recarga vale a partir do próximo evento
+@tracked_handler
+async def dispatcher(event):
+    """Captura as mensagens dos chats monitorados e encaminha para o webhook"""
+    received_at = time.monotonic()
     try:
-        # Tentativa de identificar se o evento está relacionado ao grupo
-        chat_id = None
-        if hasattr(event, 'chat_id'):
-            chat_id = event.chat_id
-        elif hasattr(event, 'message') and hasattr(event.message, 'chat_id'):
-            chat_id = event.message.chat_id
-            
-        # Log para todos os eventos Raw com detalhes do tipo
-        logger.debug(f"RAW event type: {type(event).__name__}")
-        
-        # Se o evento tiver um atributo de mensagem, tente extrair mais informações
-        if hasattr(event, 'message'):
-            logger.debug(f"RAW event message attributes: {dir(event.message)}")
-
-        # Verificar se o evento está relacionado ao grupo alvo (ignorando sinal)
-        if chat_id and abs(chat_id) == abs(GROUP_ID):
-            logger.debug(f"Evento RAW detectado no grupo alvo (abs match): {type(event).__name__}")
-            
-            # Tente enviar para o webhook
-            try:
-                raw_data = {
-                    'event': 'raw_telegram_event',
-                    'timestamp': datetime.now().isoformat(),
-                    'chat_id': chat_id,
-                    'event_type': str(type(event).__name__),
-                    'match_type': 'raw_abs_handler'
-                }
-                
-                response = requests.post(WEBHOOK_URL, json=raw_data, timeout=10)
-                logger.debug(f"Evento RAW enviado para webhook: {response.status_code}")
-            except Exception as e:
-                logger.error(f"Erro ao enviar evento RAW para webhook: {e}")
+        chat_key = normalize_chat_id(event.chat_id)
+        route_entry = routing_table.lookup(chat_key)
+        if route_entry is None:
+            if FORWARD_OTHER_CHATS:
+                await forward_other_chat(event, chat_key)
+            return
+        # Com sharding, cada chat é encaminhado apenas pela instância dona do lease
+        if not shard.owns(chat_key):
+            return
+        MESSAGES_RECEIVED.inc()
+
+        message = event.message
+        logger.debug("Nova mensagem no grupo %s: ID %s, mídia: %s",
+                     chat_key, message.id, bool(message.media))
+        if message.grouped_id and ALBUM_WINDOW > 0:
+            # Em andamento enquanto aguarda as demais partes do álbum
+            chat_state.begin(chat_key, [message.id])
+            await album_aggregator.submit(message, chat_key, route_entry, received_at)
+            return
+        if await forward_message(message, chat_key, route_entry, received_at):
+            logger.info("Mensagem capturada: %.100s...", message.text or '')
+
     except Exception as e:
-        logger.error(f"Erro ao processar evento RAW: {e}", exc_info=True)
+        logger.error(f"Erro ao processar mensagem: {e}", exc_info=True)
+
+
+async def forward_other_chat(event, chat_key):
+    """Envia um evento de teste para mensagens de chats não monitorados"""
+    test_data = {
+        'event': 'other_chat_message',
+        'timestamp': datetime.now().isoformat(),
+        'chat_id': chat_key,
+        'message': event.message.text[:100] if event.message.text else '[Sem texto]',
+        'sender_id': event.sender_id,
+        'is_target_group': False
+    }
+    for target in routing_table.webhooks:
+        await delivery_queue.put(target, test_data)
+    logger.debug("Teste de webhook com mensagem de outro chat enfileirado")
+
+
+class EditCoalescer:
+    """Agrupa edições sucessivas da mesma mensagem em uma única entrega
+
+    A primeira edição abre uma janela de window segundos; as edições seguintes da
+    mesma mensagem dentro dela apenas substituem a versão pendente (comum em
+    mensagens de bots atualizadas ao vivo).
+    """
+
+    def __init__(self, window, deliver):
+        self.window = window
+        self.deliver = deliver
+        # (chat_key, message_id) -> [message, route_entry, received_at]
+        self._pending = {}
+        self._tasks = set()
+        self._flush_now = asyncio.Event()
+        self.received = 0
+        self.coalesced = 0
+
+    async def submit(self, message, chat_key, route_entry, received_at=None):
+        self.received += 1
+        if self.window <= 0:
+            await self.deliver(message, chat_key, route_entry, received_at)
+            return
+        key = (chat_key, message.id)
+        entry = self._pending.get(key)
+        if entry is not None:
+            self.coalesced += 1
+            if edit_timestamp(message) >= edit_timestamp(entry[0]):
+                entry[0] = message
+            return
+        self._pending[key] = [message, route_entry, received_at]
+        task = asyncio.create_task(self._flush_later(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self, key):
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        message, route_entry, received_at = self._pending.pop(key)
+        try:
+            await self.deliver(message, key[0], route_entry, received_at)
+        except Exception as e:
+            logger.error(f"Erro ao encaminhar edição da mensagem {key[1]}: {e}", exc_info=True)
+
+    async def flush(self):
+        """Entrega imediatamente as edições pendentes (usado no encerramento)"""
+        self._flush_now.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._flush_now.clear()
+
+    def stats(self):
+        return {'received': self.received, 'coalesced': self.coalesced,
+                'pending': len(self._pending)}
+
+
+async def forward_edit(message, chat_key, route_entry, received_at=None):
+    """Encaminha a versão mais recente de uma mensagem editada"""
+    edit_date = getattr(message, 'edit_date', None)
+    extra = {'event': 'message_edited',
+             'edit_date': edit_date.isoformat() if edit_date else None}
+    if await forward_message(message, chat_key, route_entry, received_at,
+                             extra=extra, track_state=False):
+        logger.info("Edição da mensagem %s encaminhada", message.id)
+
+
+async def forward_event(data, chat_key, route_entry, key=None):
+    """Enfileira um evento do chat (exclusão, ação de membros) para os webhooks das rotas
+
+    Sem a mensagem não há como aplicar os filtros: vão para todos os webhooks das rotas.
+    """
+    group_id, routes = route_entry
+    if key is not None and not dedup_index.add(key):
+        logger.debug("Evento %s já encaminhado; duplicado descartado", key)
+        return False
+    captured_at = datetime.now().isoformat()
+    data = {'timestamp': captured_at, 'captured_at': captured_at,
+            'group_id': group_id, 'chat_id': chat_key, 'chat_id_abs': chat_key,
+            **data, 'idempotency_key': key}
+    body = encode_json(data)
+    try:
+        for target in RoutingTable.all_targets(routes):
+            await delivery_queue.put(target, data, batchable=True, body=body)
+    except BaseException:
+        if key is not None:
+            dedup_index.discard(key)
+        raise
+    if key is not None:
+        dedup_index.confirm(key)
+    return True
+
+
+# Atributos do ChatAction.Event, na ordem de verificação, e o nome da ação no payload
+CHAT_ACTIONS = ('user_joined', 'user_added', 'user_left', 'user_kicked',
+                'new_title', 'new_photo', 'new_pin', 'unpin', 'created')
+
+
+def chat_action_type(event):
+    for action in CHAT_ACTIONS:
+        if getattr(event, action, None):
+            return action
+    return 'other'
 
 
 # Handler para mensagens editadas
-@client.on(events.MessageEdited(chats=GROUP_ID))
+@tracked_handler
 async def edit_handler(event):
-    logger.debug(f"Mensagem editada: {event.message.id}")
-    # Você pode adicionar aqui o mesmo código de processamento do handler principal
+    received_at = time.monotonic()
+    try:
+        chat_key = normalize_chat_id(event.chat_id)
+        route_entry = routing_table.lookup(chat_key)
+        if route_entry is None or not shard.owns(chat_key):
+            return
+        logger.debug("Mensagem editada: %s", event.message.id)
+        if FORWARD_EDITS:
+            await edit_coalescer.submit(event.message, chat_key, route_entry, received_at)
+    except Exception as e:
+        logger.error(f"Erro ao processar edição: {e}", exc_info=True)
+
+
+# Handler para mensagens apagadas
+@tracked_handler
+async def delete_handler(event):
+    if not FORWARD_DELETES:
+        return
+    try:
+        # Em grupos básicos o Telegram não informa o chat das mensagens apagadas
+        if event.chat_id is None:
+            logger.debug("Mensagens apagadas sem chat identificado: %s", event.deleted_ids)
+            return
+        chat_key = normalize_chat_id(event.chat_id)
+        route_entry = routing_table.lookup(chat_key)
+        if route_entry is None or not shard.owns(chat_key):
+            return
+        message_ids = sorted(event.deleted_ids)
+        data = {'event': 'message_deleted', 'message_ids': message_ids}
+        key = idempotency_key(chat_key, ','.join(map(str, message_ids)), 'deleted')
+        if await forward_event(data, chat_key, route_entry, key):
+            logger.info("Exclusão de %d mensagem(ns) encaminhada", len(message_ids))
+    except Exception as e:
+        logger.error(f"Erro ao processar exclusão: {e}", exc_info=True)
 
 
 # Handler para ações de chat (entrada/saída de membros, etc)
-@client.on(events.ChatAction(chats=GROUP_ID))
+@tracked_handler
 async def chat_action_handler(event):
-    logger.debug(f"Ação de chat detectada no grupo: {event.action_message}")
+    try:
+        chat_key = normalize_chat_id(event.chat_id)
+        route_entry = routing_table.lookup(chat_key)
+        if route_entry is None:
+            return
+        # Entradas, saídas e mudanças no chat deixam os dados em cache desatualizados
+        for user_id in event.user_ids or ():
+            entity_cache.invalidate_user(user_id)
+        if event.new_title or event.new_photo:
+            entity_cache.invalidate_chat(chat_key)
+        logger.debug("Ação de chat detectada no grupo: %s", event.action_message)
+        if not FORWARD_CHAT_ACTIONS or not shard.owns(chat_key):
+            return
+        action_message = event.action_message
+        action = chat_action_type(event)
+        data = {
+            'event': 'chat_action',
+            'action': action,
+            'user_ids': list(event.user_ids or ()),
+            'new_title': event.new_title,
+            'message_id': action_message.id if action_message else None,
+            'date': action_message.date.isoformat() if action_message else None,
+        }
+        key = (idempotency_key(chat_key, action_message.id, 'action')
+               if action_message else None)
+        if await forward_event(data, chat_key, route_entry, key):
+            logger.info("Ação de chat '%s' encaminhada", action)
+    except Exception as e:
+        logger.error(f"Erro ao processar ação de chat: {e}", exc_info=True)
+
+
+# Handlers de atualizações do Telegram, registrados apenas no modo contínuo (run)
+EVENT_HANDLERS = (
+    (dispatcher, events.NewMessage()),
+    (edit_handler, events.MessageEdited()),
+    (delete_handler, events.MessageDeleted()),
+    (chat_action_handler, events.ChatAction()),
+)
+
+
+def register_handlers():
+    for callback, event in EVENT_HANDLERS:
+        client.add_event_handler(callback, event)
+
+
+def unregister_handlers():
+    for callback, _ in EVENT_HANDLERS:
+        client.remove_event_handler(callback)
+
+
+async def backfill_chat(chat_id, min_id=0, max_id=0, since=None, until=None,
+                        limit=None, extra=None, track_state=True, dedupe=True, progress=None):
+    """Percorre o histórico do chat em ordem cronológica e encaminha pelo mesmo pipeline
+
+    min_id e max_id são exclusivos. A fila de entrega limita o ritmo (contrapressão) e
+    FloodWait do Telegram é respeitado retomando do último ID processado. Se informado,
+    progress recebe 'seen' (mensagens lidas) e 'last_id' (último ID lido).
+    """
+    progress = {} if progress is None else progress
+    progress.update(seen=0, last_id=min_id)
+    chat_key = normalize_chat_id(chat_id)
+    route_entry = routing_table.lookup(chat_key)
+    if route_entry is None:
+        raise ValueError(f"Chat {chat_id} não está em nenhuma rota")
+    entity = await rate_limiter.call(client.get_entity, chat_id, priority=PRIORITY_LOW)
+    seen = 0
+    forwarded = 0
+    # Partes consecutivas de um álbum ainda não encaminhadas (sobrevivem a um FloodWait)
+    album = []
+
+    async def flush_album():
+        nonlocal forwarded
+        if album:
+            parts = album[:]
+            album.clear()
+            if await forward_album(parts, chat_key, route_entry, extra=extra,
+                                   track_state=track_state, dedupe=dedupe):
+                forwarded += len(parts)
+
+    while True:
+        try:
+            async for message in client.iter_messages(
+                    entity, min_id=min_id, max_id=max_id, offset_date=since, reverse=True,
+                    limit=None if limit is None else limit - seen,
+                    wait_time=CATCHUP_WAIT_TIME):
+                if until is not None and message.date > until:
+                    await flush_album()
+                    return forwarded
+                seen += 1
+                min_id = message.id
+                progress.update(seen=seen, last_id=min_id)
+                # Mensagens de serviço (entradas, saídas etc.) não são encaminhadas
+                if getattr(message, 'action', None) is not None:
+                    continue
+                if album and message.grouped_id != album[0].grouped_id:
+                    await flush_album()
+                if message.grouped_id and ALBUM_WINDOW > 0:
+                    album.append(message)
+                    continue
+                if await forward_message(message, chat_key, route_entry,
+                                         extra=extra, track_state=track_state,
+                                         dedupe=dedupe):
+                    forwarded += 1
+                    if forwarded % 1000 == 0:
+                        logger.info(f"Histórico do chat {chat_id}: {forwarded} mensagens enfileiradas")
+            await flush_album()
+            return forwarded
+        except FloodWaitError as e:
+            # Registra no limitador para que as demais chamadas também aguardem
+            rate_limiter.on_flood_wait(e.seconds)
+            logger.warning(f"FloodWait no histórico do chat {chat_id}: aguardando {e.seconds}s")
+            await asyncio.sleep(e.seconds)
+            if seen:
+                # O progresso já está em min_id
+                since = None
+
+
+def catch_up_state():
+    """Último ID encaminhado de cada chat monitorado (local ou registrado no lease)
+
+    Deve ser lido antes de registrar os handlers: as mensagens ao vivo avançam o
+    estado e esconderiam a lacuna do período fora do ar.
+    """
+    last_ids = {}
+    for chat_id in routing_table.chat_ids:
+        chat_key = normalize_chat_id(chat_id)
+        known = [last_id for last_id in (chat_state.get(chat_key), shard.last_message_id(chat_key))
+                 if last_id is not None]
+        last_ids[chat_key] = max(known) if known else None
+    return last_ids
+
+
+async def catch_up(last_ids=None):
+    """Encaminha as mensagens enviadas enquanto o serviço esteve fora do ar
+
+    Cada chat recupera até CATCHUP_MAX_MESSAGES por rodada; os que atingem o limite
+    continuam de onde pararam nas rodadas seguintes, depois dos demais chats.
+    """
+    if last_ids is None:
+        last_ids = catch_up_state()
+    pending = [(chat_key, last_id, None) for chat_key, last_id in last_ids.items()]
+    while pending:
+        remaining = []
+        for chat_key, last_id, max_id in pending:
+            if not shard.owns(chat_key):
+                continue
+            resume = await catch_up_chat(chat_key, last_id, max_id)
+            if resume is not None:
+                remaining.append((chat_key, *resume))
+        pending = remaining
+
+
+async def catch_up_gained(chat_key, last_id):
+    """Catch-up completo de um chat assumido de outra instância (sharding)"""
+    resume = (last_id, None)
+    while resume is not None and shard.owns(chat_key):
+        resume = await catch_up_chat(chat_key, *resume)
+
+
+async def catch_up_chat(chat_key, last_id, max_id=None):
+    """Uma rodada do catch-up do chat após last_id
+
+    Devolve (último ID lido, max_id) quando CATCHUP_MAX_MESSAGES foi atingido antes do
+    fim da lacuna, para continuar em outra rodada; senão None.
+    """
+    route_entry = routing_table.lookup(chat_key)
+    if route_entry is None:
+        return None
+    chat_id = route_entry[0]
+    if last_id is None:
+        logger.info(f"Catch-up: sem histórico registrado para o chat {chat_id}, ignorando")
+        return None
+    try:
+        if max_id is None:
+            # Limite superior fixo: mensagens mais novas chegam pelo handler normal
+            latest = await rate_limiter.call(
+                client.get_messages, chat_id, limit=1, priority=PRIORITY_LOW)
+            max_id = latest[0].id + 1 if latest else 0
+            if max_id and max_id - 1 <= last_id:
+                return None
+        progress = {}
+        count = await backfill_chat(
+            chat_id, min_id=last_id, max_id=max_id, limit=CATCHUP_MAX_MESSAGES,
+            extra={'backfill': 'catchup'}, progress=progress)
+        logger.info(f"Catch-up do chat {chat_id}: {count} mensagens recuperadas após o ID {last_id}")
+        if progress['seen'] >= CATCHUP_MAX_MESSAGES and (not max_id or progress['last_id'] < max_id - 1):
+            logger.warning(
+                f"Catch-up do chat {chat_id} atingiu CATCHUP_MAX_MESSAGES ({CATCHUP_MAX_MESSAGES}); "
+                f"continuando após o ID {progress['last_id']} na próxima rodada")
+            return progress['last_id'], max_id
+    except Exception as e:
+        logger.error(f"Erro no catch-up do chat {chat_id}: {e}", exc_info=True)
+    return None
+
+
+async def broadcast(data):
+    """Envia um evento de controle diretamente a todos os webhooks configurados
+
+    Webhooks com o circuito aberto são ignorados para não aumentar a carga.
+    """
+    urls = []
+    for url in routing_table.webhooks:
+        if webhook_targets.get(url).available_in() > 0:
+            logger.info(f"Webhook {url} indisponível (circuito aberto); evento de controle ignorado")
+        else:
+            urls.append(url)
+    results = await asyncio.gather(
+        *(webhook_client.post(url, data) for url in urls), return_exceptions=True)
+    return dict(zip(urls, results))
+
+
+reload_lock = asyncio.Lock()
+
 
+async def reload_routes():
+    """Relê ROUTES_FILE e troca a tabela de rotas sem reconectar ao Telegram
+
+    A nova tabela é validada por completo antes da troca, feita com uma única
+    atribuição: cada evento vê a tabela antiga ou a nova, nunca uma mistura. A fila
+    de entrega, o outbox e a sessão continuam os mesmos; payloads já enfileirados
+    seguem para os webhooks da configuração anterior.
+    """
+    global routing_table
+    if shutting_down:
+        raise RuntimeError("Serviço em encerramento; recarga ignorada")
+    if not ROUTES_FILE:
+        CONFIG_RELOADS.inc(result='error')
+        raise ValueError("A recarga exige ROUTES_FILE; mudanças em GROUP_ID/WEBHOOK_URL exigem reinício")
+    async with reload_lock:
+        try:
+            new_table = await asyncio.to_thread(load_routing_table, ROUTES_FILE)
+        except Exception:
+            CONFIG_RELOADS.inc(result='error')
+            raise
+        old_table = routing_table
+        routing_table = new_table
+        CONFIG_RELOADS.inc(result='ok')
+
+    old_chats = {normalize_chat_id(chat_id): chat_id for chat_id in old_table.chat_ids}
+    new_chats = {normalize_chat_id(chat_id): chat_id for chat_id in new_table.chat_ids}
+    summary = {
+        'routes': len(new_table.routes),
+        'chats_added': sorted(new_chats.keys() - old_chats.keys()),
+        'chats_removed': sorted(old_chats.keys() - new_chats.keys()),
+        'webhooks_added': [url for url in new_table.webhooks if url not in old_table.webhooks],
+        'webhooks_removed': [url for url in old_table.webhooks if url not in new_table.webhooks],
+    }
+    logger.info(f"Rotas recarregadas: {summary}")
+
+    if summary['chats_added'] and client.is_connected():
+        spawn(entity_cache.prefill(
+            client, [new_chats[chat_key] for chat_key in summary['chats_added']],
+            ENTITY_PREFILL_LIMIT))
+    # Com sharding, os leases são redistribuídos imediatamente entre os chats atuais
+    if shard.active:
+        for chat_key, last_id in (await shard.sync()).items():
+            spawn(catch_up_gained(chat_key, last_id))
+    return summary
+
+
+async def handle_reload_signal():
+    try:
+        await reload_routes()
+    except Exception as e:
+        logger.error(f"Erro ao recarregar as rotas (configuração anterior mantida): {e}")
+
+
+def parse_datetime(value):
+    """Data/hora ISO 8601 (sem fuso = UTC), usada nos argumentos da exportação"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Encaminha mensagens de grupos do Telegram para webhooks do n8n")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser(
+        'run', help="(padrão) escuta novas mensagens e encaminha continuamente")
+    subparsers.add_parser(
+        'catchup', help="encaminha as mensagens perdidas desde a última execução e encerra")
+    export = subparsers.add_parser(
+        'export', help="encaminha um intervalo do histórico de um chat e encerra")
+    export.add_argument('--chat', type=int, required=True,
+                        help="ID do chat (precisa estar em uma rota)")
+    export.add_argument('--from-id', type=int, default=None,
+                        help="primeiro message_id incluído")
+    export.add_argument('--to-id', type=int, default=None,
+                        help="último message_id incluído")
+    export.add_argument('--since', type=parse_datetime, default=None,
+                        help="data/hora inicial (ISO 8601)")
+    export.add_argument('--until', type=parse_datetime, default=None,
+                        help="data/hora final (ISO 8601)")
+    export.add_argument('--limit', type=int, default=None,
+                        help="máximo de mensagens lidas")
+    args = parser.parse_args(argv)
+    args.command = args.command or 'run'
+    return args
+
+
+async def run_once(args):
+    """Modos catchup/export: encaminha o histórico, aguarda a entrega e encerra
+
+    Os handlers não são registrados: mensagens novas ficam a cargo da instância em
+    execução contínua.
+    """
+    if args.command == 'catchup':
+        # Com sharding, apenas os chats cujo lease esta instância obtiver
+        await catch_up(await shard.start() if shard.store is not None else None)
+    else:
+        count = await backfill_chat(
+            args.chat,
+            min_id=args.from_id - 1 if args.from_id else 0,
+            max_id=args.to_id + 1 if args.to_id else 0,
+            since=args.since,
+            until=args.until,
+            limit=args.limit,
+            extra={'backfill': 'export'},
+            track_state=False,
+            dedupe=False)
+        logger.info(f"Exportação do chat {args.chat}: {count} mensagens enfileiradas")
+
+    logger.info("Aguardando a entrega das mensagens enfileiradas...")
+    await delivery_queue.join()
+    logger.info(f"Concluído: {delivery_queue.stats()}")
+
+
+# Cliente do Telegram e componentes do serviço, criados por init_components() no início
+# de main: importar o módulo (benchmarks, ferramentas) não abre arquivos nem conexões
+client = None
+webhook_client = None
+webhook_targets = None
+outbox = None
+delivery_queue = None
+rate_limiter = None
+media_spool = None
+routing_table = None
+entity_cache = None
+chat_state = None
+dedup_index = None
+shard = None
+album_aggregator = None
+edit_coalescer = None
+
+
+def init_components():
+    """Configura o log, carrega as rotas e cria o cliente do Telegram e os componentes"""
+    global client, webhook_client, webhook_targets, outbox, delivery_queue, rate_limiter
+    global media_spool, routing_table, entity_cache, chat_state, dedup_index, shard
+    global album_aggregator, edit_coalescer
+    setup_logging()
+    logger.info("Iniciando aplicação Telegram Forwarder")
+
+    # Verificar se o diretório de sessão existe e tem permissões corretas
+    session_dir = os.path.dirname(SESSION_PATH)
+    os.makedirs(session_dir, exist_ok=True)
+    # Garantir permissões no diretório de sessão
+    os.chmod(session_dir, 0o777)  # rwxrwxrwx
+    logger.info(f"Diretório de sessão {session_dir} verificado e com permissões atualizadas")
+
+    # Iniciar cliente com caminho absoluto
+    client = TelegramClient(SESSION_PATH, API_ID, API_HASH,
+                            flood_sleep_threshold=TELEGRAM_FLOOD_SLEEP_THRESHOLD)
+    logger.info(f"Usando arquivo de sessão em: {SESSION_PATH}")
+
+    routing_table = load_routing_table(ROUTES_FILE)
+    logger.info(
+        f"Rotas carregadas: {len(routing_table.routes)} rotas, "
+        f"{len(routing_table.chat_ids)} chats, {len(routing_table.webhooks)} webhooks")
+
+    # Cliente único (pool compartilhado entre todos os webhooks) usado por todos os caminhos de entrega
+    webhook_client = WebhookClient(
+        pool_size=WEBHOOK_POOL_SIZE,
+        timeout=WEBHOOK_TIMEOUT,
+        connect_timeout=WEBHOOK_CONNECT_TIMEOUT,
+        keepalive=WEBHOOK_KEEPALIVE,
+    )
+    webhook_targets = WebhookTargets(
+        min_limit=WEBHOOK_MIN_CONCURRENCY,
+        max_limit=WEBHOOK_MAX_CONCURRENCY,
+        latency_target=WEBHOOK_LATENCY_TARGET,
+        failure_threshold=WEBHOOK_BREAKER_THRESHOLD,
+        cooldown=WEBHOOK_BREAKER_COOLDOWN,
+    )
+    outbox = Outbox(
+        OUTBOX_PATH,
+        commit_interval=OUTBOX_COMMIT_INTERVAL,
+        commit_batch=OUTBOX_COMMIT_BATCH,
+    ) if OUTBOX_ENABLED else None
+    delivery_queue = DeliveryQueue(
+        webhook_client,
+        maxsize=DELIVERY_QUEUE_SIZE,
+        workers=DELIVERY_WORKERS,
+        policy=DELIVERY_BACKPRESSURE,
+        spill_path=DELIVERY_SPILL_PATH,
+        max_retries=DELIVERY_MAX_RETRIES,
+        outbox=outbox,
+        targets=webhook_targets,
+        batch_size=WEBHOOK_BATCH_SIZE,
+        batch_window=WEBHOOK_BATCH_WINDOW_MS / 1000,
+        batch_max_bytes=WEBHOOK_BATCH_MAX_BYTES,
+    )
+
+    rate_limiter = TelegramRateLimiter(
+        rate=TELEGRAM_RATE_LIMIT,
+        min_rate=TELEGRAM_MIN_RATE,
+        burst=TELEGRAM_BURST,
+        max_downloads=MEDIA_MAX_CONCURRENT_DOWNLOADS,
+    )
+    FloodSleepObserver(rate_limiter).install()
+    media_spool = MediaSpool(
+        MEDIA_SPOOL_DIR,
+        inline_max_bytes=MEDIA_INLINE_MAX_BYTES,
+        public_url=MEDIA_PUBLIC_URL,
+        max_bytes=MEDIA_CACHE_MAX_BYTES,
+    )
+    entity_cache = EntityCache(max_size=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+
+    chat_state = ChatStateStore(STATE_PATH)
+    dedup_index = DedupIndex(
+        window=DEDUP_WINDOW,
+        max_entries=DEDUP_MAX_ENTRIES,
+        path=DEDUP_PATH or None,
+    )
+    shard = ShardCoordinator(
+        ShardLeaseStore(SHARD_LEASE_PATH, SHARD_INSTANCE_ID, SHARD_LEASE_TTL) if SHARDING_ENABLED else None,
+        renew_interval=SHARD_RENEW_INTERVAL,
+    )
+    album_aggregator = AlbumAggregator(ALBUM_WINDOW, forward_live_album)
+    edit_coalescer = EditCoalescer(EDIT_COALESCE_WINDOW, forward_edit)
+
+
+async def main(args=None):
+    args = args or parse_args([])
+    init_components()
+
+    # Abrir o outbox e iniciar a fila de entrega antes de receber atualizações
+    if outbox is not None:
+        outbox.open()
+        outbox.start()
+    chat_state.open()
+    chat_state.start()
+    dedup_index.open()
+    dedup_index.start()
+    delivery_queue.start()
+    media_spool.open()
+    http_runner = await start_http_server()
 
-async def main():
     # Iniciar cliente
     logger.info("Iniciando cliente Telegram...")
     
@@ -440,8 +3431,32 @@ async def main():
     # Verificar conexão
     me = await client.get_me()
     logger.info(f"Conectado como: {me.first_name} (ID: {me.id})")
-    logger.info(f"Monitorando o grupo ID: {GROUP_ID}")
-    logger.info(f"Webhook configurado para: {WEBHOOK_URL}")
+    for route in routing_table.routes:
+        logger.info(f"Rota '{route.name}': chats {route.chats} -> webhooks {route.webhooks}")
+
+    if args.command != 'run':
+        try:
+            await run_once(args)
+        finally:
+            await shutdown(http_runner)
+        return
+
+    # Com sharding, obtém os leases antes de tratar mensagens ao vivo (sem isso todas as
+    # réplicas encaminhariam todos os chats). Lido antes dos handlers: mensagens ao vivo
+    # não podem esconder a lacuna do catch-up
+    if shard.store is not None:
+        last_ids = await shard.start(on_gained=catch_up_gained)
+    else:
+        last_ids = catch_up_state()
+    register_handlers()
+
+    # SIGHUP recarrega as rotas; SIGTERM/SIGINT encerram esvaziando a fila de entrega
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    with contextlib.suppress(NotImplementedError, AttributeError):
+        loop.add_signal_handler(signal.SIGHUP, lambda: spawn(handle_reload_signal()))
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop_event.set)
 
     # Teste periódico do webhook
     async def periodic_test():
@@ -450,52 +3465,132 @@ async def main():
                 test_data = {
                     'event': 'heartbeat',
                     'timestamp': datetime.now().isoformat(),
-                    'status': 'running'
+                    'status': 'running',
+                    'delivery': delivery_queue.last_stats,
+                    'media_cache': media_spool.stats(),
+                    'entity_cache': entity_cache.stats(),
+                    'telegram_rate_limiter': rate_limiter.stats(),
+                    'dedup': dedup_index.stats(),
+                    'shard': shard.stats()
                 }
                 logger.info(f"Enviando teste periódico para webhook...")
-                response = requests.post(
-                    WEBHOOK_URL, json=test_data, timeout=10)
-                logger.info(
-                    f"Resposta do webhook (teste periódico): {response.status_code}")
+                for url, response in (await broadcast(test_data)).items():
+                    if isinstance(response, Exception):
+                        logger.error(f"Erro ao enviar teste periódico para {url}: {response}")
+                    else:
+                        logger.info(
+                            f"Resposta do webhook {url} (teste periódico): {response.status_code}")
             except Exception as e:
                 logger.error(
                     f"Erro ao enviar teste periódico: {e}", exc_info=True)
             await asyncio.sleep(60)  # teste a cada 60 segundos
 
-    # Inicie o teste periódico
-    client.loop.create_task(periodic_test())
+    # Estatísticas da fila de entrega para dimensionamento
+    async def periodic_stats():
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL)
+            logger.info(f"Estatísticas da fila de entrega: {delivery_queue.stats()}")
+            logger.info(f"Estatísticas do cache de mídia: {media_spool.stats()}")
+            logger.info(f"Estatísticas do cache de entidades: {entity_cache.stats()}")
+            logger.info(f"Estatísticas do limitador do Telegram: {rate_limiter.stats()}")
+            logger.info(f"Estatísticas do índice de duplicados: {dedup_index.stats()}")
+            logger.info(f"Estatísticas das edições: {edit_coalescer.stats()}")
+            logger.info(f"Estatísticas dos álbuns: {album_aggregator.stats()}")
+            if shard.active:
+                logger.info(f"Estatísticas do sharding: {shard.stats()}")
 
-    # Enviar notificação de início para webhook
-    try:
-        startup_data = {
-            'event': 'startup',
-            'timestamp': datetime.now().isoformat(),
-            'client_id': me.id,
-            'client_name': me.first_name,
-            'group_id': GROUP_ID,
-            'abs_group_id': abs(GROUP_ID)
-        }
-        requests.post(WEBHOOK_URL, json=startup_data)
-        logger.info("Notificação de inicialização enviada para webhook")
-    except Exception as e:
-        logger.error(f"Erro ao enviar notificação de inicialização: {e}")
+    # Pré-carregar chats monitorados e participantes em segundo plano
+    spawn(entity_cache.prefill(
+        client, routing_table.chat_ids, ENTITY_PREFILL_LIMIT))
+
+    # Inicie o teste periódico e a medição de atraso do loop
+    spawn(periodic_test())
+    spawn(monitor_event_loop_lag())
+    spawn(periodic_stats())
+
+    # Reenviar o que ficou pendente no outbox (inclusive de execuções anteriores)
+    if outbox is not None:
+        spawn(delivery_queue.redrive_loop(
+            OUTBOX_REDRIVE_INTERVAL, OUTBOX_COMPACT_INTERVAL))
+
+    # Enviar notificação de início para webhook (em segundo plano: um webhook lento
+    # não atrasa o catch-up)
+    async def notify_startup():
+        try:
+            startup_data = {
+                'event': 'startup',
+                'timestamp': datetime.now().isoformat(),
+                'client_id': me.id,
+                'client_name': me.first_name,
+                'group_id': GROUP_ID,
+                'abs_group_id': abs(GROUP_ID) if GROUP_ID is not None else None,
+                'monitored_chats': routing_table.chat_ids
+            }
+            await broadcast(startup_data)
+            logger.info("Notificação de inicialização enviada para webhook")
+        except Exception as e:
+            logger.error(f"Erro ao enviar notificação de inicialização: {e}")
+
+    spawn(notify_startup())
 
-    # Manter executando até ser desconectado
+    # Recuperar as mensagens enviadas enquanto o serviço esteve parado
+    if CATCHUP_ON_START:
+        spawn(catch_up(last_ids))
+
+    # Manter executando até ser desconectado ou receber um sinal de encerramento
     logger.info("Cliente Telegram iniciado. Aguardando mensagens...")
-    await client.run_until_disconnected()
+    running = asyncio.create_task(client.run_until_disconnected())
+    stopping = asyncio.create_task(stop_event.wait())
+    try:
+        await asyncio.wait({running, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        if running.done():
+            running.result()
+        else:
+            logger.info("Sinal de encerramento recebido; encerrando...")
+    finally:
+        stopping.cancel()
+        await shutdown(http_runner)
+        await asyncio.gather(running, return_exceptions=True)
 
-if __name__ == '__main__':
-    # Criar diretório de logs se não existir
-    os.makedirs("/app/logs", exist_ok=True)
-    
-    # Verificar se o diretório de sessão existe e tem permissões corretas
-    session_dir = os.path.dirname(SESSION_PATH)
-    os.makedirs(session_dir, exist_ok=True)
-    
-    # Garantir permissões no diretório de sessão
-    os.chmod(session_dir, 0o777)  # rwxrwxrwx
-    logger.info(f"Diretório de sessão {session_dir} verificado e com permissões atualizadas")
 
+async def shutdown(http_runner):
+    """Encerramento gradual: para de receber, esvazia a fila e só então desconecta"""
+    global shutting_down
+    shutting_down = True
+    # Novas atualizações deixam de ser tratadas; a conexão continua para os downloads pendentes
+    unregister_handlers()
+    # Nada mais é enfileirado: catch-up, redrive, heartbeats e pré-carga são interrompidos
+    # (o que o catch-up não alcançou é retomado na próxima execução)
+    await shard.stop_renewal()
+    await cancel_background_tasks()
+    # Atualizações já recebidas (ex.: baixando mídia) terminam de ser enfileiradas
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    await wait_handler_tasks(SHUTDOWN_DRAIN_TIMEOUT)
+    # Edições e álbuns ainda na janela de agrupamento são enfileirados antes de parar a fila
+    await edit_coalescer.flush()
+    await album_aggregator.flush()
+    if SHUTDOWN_DRAIN_TIMEOUT > 0:
+        try:
+            await asyncio.wait_for(
+                delivery_queue.join(), max(deadline - time.monotonic(), 0.1))
+        except asyncio.TimeoutError:
+            pending = delivery_queue._queue.qsize() + delivery_queue._busy
+            delivery_logger.warning(
+                f"Fila de entrega não esvaziou em {SHUTDOWN_DRAIN_TIMEOUT:g}s; "
+                f"{pending} payloads pendentes ficam no outbox para a próxima execução")
+    # Só depois de esvaziar a fila os leases são liberados para outra instância
+    await shard.close()
+    await delivery_queue.stop()
+    if outbox is not None:
+        await outbox.close()
+    await chat_state.close()
+    await dedup_index.close()
+    await webhook_client.close()
+    await http_runner.cleanup()
+    media_spool.close()
+    if client.is_connected():
+        await client.disconnect()
+
+if __name__ == '__main__':
     # Executar o loop assíncrono
-    logger.info("Iniciando aplicação Telegram Forwarder")
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))